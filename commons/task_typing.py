@@ -1,7 +1,7 @@
 from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import PosixPath
-from typing import List, Optional, TypeVar, Union
+from typing import Dict, List, Optional, TypeVar, Union
 
 from typing_extensions import Generic, Literal
 
@@ -40,6 +40,11 @@ class ResourceUsage:
     memory_bytes: int
     file_count: int
     file_size_bytes: int
+    # user + sys cpu time of the program, or of the whole sandbox when
+    # runner.c cannot report it but a cgroup is in use.
+    cpu_time_msecs: Optional[int] = None
+    # user space instructions retired, if hardware counters are available.
+    instructions: Optional[int] = None
 
 @dataclass
 class CompileTask:
@@ -47,10 +52,16 @@ class CompileTask:
     supplementary_files: List[FileUrl]
     artifact: Optional[Artifact]
     limits: ResourceUsage
+    # a supplementary header shared by many compile tasks, which the runner
+    # may precompile and reuse.
+    precompile_header: Optional[str] = None
 
 
 Input = Union[CompileTask, Artifact]
 
+# which measurement is compared against limits.time_msecs.
+TimeMetric = Literal['realtime', 'cputime', 'instructions']
+
 
 @dataclass
 class RunArgs:
@@ -62,19 +73,26 @@ class RunArgs:
     infile: Optional[FileUrl]
     supplementary_files: List[FileUrl]
     outfile: Optional[Artifact] = None
+    timing: TimeMetric = 'realtime'
 
 
 @dataclass
 class CompareChecker:
     ignore_whitespace: bool
     answer: FileUrl
+    # NormalizedDigest of the answer, computed at plan time; outputs with
+    # the same digest are accepted without fetching the answer.
+    answer_digest: Optional[str] = None
+    answer_size: Optional[int] = None
 
 @dataclass
 class DirectChecker: pass
 
 @dataclass
 class SpjChecker:
-    format: Literal['checker', 'scorer']
+    # 'batch': one checker process judges all testpoints of a task, see
+    # judger2/steps/spj_batch.py.
+    format: Literal['checker', 'scorer', 'batch']
     executable: Input
     answer: Optional[FileUrl]
     supplementary_files: List[FileUrl]
@@ -101,6 +119,14 @@ class JudgeTask(Generic[_TestpointInput]):
 Task = TypeVar('Task', CompileTask, JudgeTask[Input])
 
 
+@dataclass
+class PrefetchRequest:
+    '''Published to the runners of a group when a problem is updated.'''
+    problem_id: str
+    # signed urls of the files of the problem, in the order they are used.
+    urls: List[Url]
+
+
 # runner -> scheduler, runner internal state
 
 CompileError = Literal['compile_error']
@@ -144,10 +170,18 @@ CompileResultType = Union[
     Compiled,
 ]
 
+@dataclass
+class PhaseTiming:
+    # e.g. fetch, stage, compile, execute, check, upload; see judger2/metrics.py.
+    phase: str
+    secs: float
+
 @dataclass
 class CompileResult:
     result: CompileResultType
     message: str
+    # where the runner spent its time; for maintainers, not shown to users.
+    phases: List[PhaseTiming] = field(default_factory=list)
 
 @dataclass
 class RunResult:
@@ -157,6 +191,9 @@ class RunResult:
     code: Optional[int] = None # for runtime errors
     output_path: Optional[PosixPath] = None
     input_path: Optional[PosixPath] = None
+    cpu: Optional[int] = None # the cpu the sandbox was pinned to
+    # wall time spent in each phase of the sandbox run, in secs
+    phase_secs: Dict[str, float] = field(default_factory=lambda: {})
 
 @dataclass
 class CompileLocalResult:
@@ -188,6 +225,8 @@ class TestpointJudgeResult:
     message: str
     score: float = 0.0
     resource_usage: Optional[ResourceUsage] = None
+    # where the runner spent its time; for maintainers, not shown to users.
+    phases: List[PhaseTiming] = field(default_factory=list)
 
 @dataclass
 class CheckResult:
@@ -211,6 +250,10 @@ class StatusUpdateStarted:
 class StatusUpdateProgress:
     result: Result
 @dataclass
+class StatusUpdateProgressDelta:
+    # testpoints finished since the last progress update of the task.
+    testpoints: List[TestpointJudgeResult]
+@dataclass
 class StatusUpdateDone:
     result: Result
 @dataclass
@@ -220,11 +263,26 @@ class StatusUpdateError:
 StatusUpdate = Union[
     StatusUpdateStarted,
     StatusUpdateProgress,
+    StatusUpdateProgressDelta,
     StatusUpdateDone,
     StatusUpdateError,
 ]
 
 
+@dataclass
+class RunnerHeartbeat:
+    '''Sent by a runner into the runners hash of its group.'''
+    time: float
+    slots: int
+    # tasks the runner is running, at most one per slot.
+    task_ids: List[str]
+    cache_bytes: int = 0
+    # 1-minute load average of the runner machine.
+    loadavg: float = 0.0
+    compile_cache_hits: int = 0
+    compile_cache_misses: int = 0
+
+
 # scheduler internal state
 
 class CodeLanguage(Enum):
@@ -245,6 +303,7 @@ class CompileTaskPlan:
     supplementary_files: List[Union[FileUrl, UserCode]]
     artifact: bool
     limits: ResourceUsage
+    precompile_header: Optional[str] = None
 
 @dataclass
 class JudgeTaskPlan:
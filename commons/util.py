@@ -1,13 +1,19 @@
 import json
 from asyncio import get_running_loop
 from dataclasses import dataclass, is_dataclass
+from hashlib import sha256
 from logging import getLogger
 from pathlib import PosixPath
+from re import compile as re_compile
 from shutil import rmtree
 from traceback import format_exception
-from typing import Any, Callable, Dict, Optional, Type, TypeVar
+from typing import (TYPE_CHECKING, Any, Callable, Dict, Optional, Type,
+                    TypeVar)
 from uuid import uuid4
 
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
 
 logger = getLogger(__name__)
 
@@ -83,13 +89,22 @@ def deserialize(data: str) -> Any:
 
 working_dir = None
 before_exit = None
+remove = None
+
+def remove_temp_dir(path: PosixPath):
+    try:
+        if before_exit is not None:
+            before_exit(path)
+        rmtree(path, ignore_errors=True)
+    except Exception as e:
+        logger.error(f'error removing temp dir {path}: {format_exc(e)}')
 
 class TempDir:
     path: PosixPath
-    def __init__(self):
+    def __init__(self, parent: Optional[PosixPath] = None):
         if working_dir is None:
             raise ValueError('TempDir is not initialized')
-        self.path = PosixPath(working_dir) / str(uuid4())
+        self.path = PosixPath(parent or working_dir) / str(uuid4())
     def __enter__(self) -> PosixPath:
         logger.debug(f'entering temp dir {self.path}')
         self.path.mkdir()
@@ -97,18 +112,84 @@ class TempDir:
         return self.path
     def __exit__(self, *_args):
         logger.debug(f'exiting temp dir {self.path}')
-        try:
-            if before_exit is not None:
-                before_exit(self.path)
-            rmtree(self.path, ignore_errors=True)
-        except Exception as e:
-            logger.error(f'error removing temp dir {self.path}: {format_exc(e)}')
+        if remove is not None:
+            # e.g. hands the dir over to a background worker.
+            remove(self.path)
+        else:
+            remove_temp_dir(self.path)
 
     @staticmethod
-    def config(_working_dir, _before_exit = None):
-        global working_dir, before_exit
+    def config(_working_dir, _before_exit = None, _remove = None):
+        '''
+        _before_exit is called on the dir before it is removed. If _remove
+        is given, the dir is passed to it on exit instead of being removed
+        right away with remove_temp_dir.
+        '''
+        global working_dir, before_exit, remove
         working_dir = _working_dir
         before_exit = _before_exit
+        remove = _remove
+
+
+class NormalizedDigest:
+    '''
+    sha256 of a file with trailing whitespace of every line and blank lines
+    removed, with each remaining line terminated by a newline. Two files
+    have the same digest iff `checker -ZB` considers them the same.
+    '''
+
+    _trailing_space = re_compile(rb'[ \t\r\v\f]+\n')
+    _blank_lines = re_compile(rb'\n\n+')
+
+    def __init__(self):
+        self._hash = sha256()
+        self.size = 0
+        # whitespace at the end of data seen so far, not yet known to be
+        # trailing.
+        self._pending = b''
+        # whether part of the current line has been hashed.
+        self._mid_line = False
+
+    def _emit(self, data: bytes):
+        self._hash.update(data)
+        self.size += len(data)
+
+    def update(self, data: bytes):
+        data = self._pending + data
+        cut = data.rfind(b'\n') + 1
+        block, rest = data[:cut], data[cut:]
+        if block != b'':
+            block = self._trailing_space.sub(b'\n', block)
+            block = self._blank_lines.sub(b'\n', block)
+            if block.startswith(b'\n') and not self._mid_line:
+                block = block[1:]
+            self._mid_line = False
+            self._emit(block)
+        # hash the unfinished line right away, so that a long line does not
+        # need to be kept in memory.
+        line = rest.rstrip()
+        if line != b'':
+            self._emit(line)
+            self._mid_line = True
+        self._pending = rest[len(line):]
+
+    def finish(self) -> str:
+        if self._mid_line:
+            self._emit(b'\n')
+            self._mid_line = False
+        self._pending = b''
+        return self._hash.hexdigest()
+
+    @staticmethod
+    def of_file(file, chunk_size: int = 1048576) -> 'NormalizedDigest':
+        digest = NormalizedDigest()
+        while len(data := file.read(chunk_size)) > 0:
+            digest.update(data)
+        digest.finish()
+        return digest
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
 
 
 class RedisQueues:
@@ -122,12 +203,16 @@ class RedisQueues:
             return f'{prefix}-{name}'
         self._prefix = prefix
         self._task_prefix = queue('task')
+        self.runner_groups = queue('runner-groups')
         if runner is not None:
             def rqueue(name):
                 return f'{queue(name)}-runner{runner.id}'
             self.tasks = queue(f'{runner.group}-tasks')
+            self.runners = queue(f'{runner.group}-runners')
+            self.prefetch = queue(f'{runner.group}-prefetch')
             self.in_progress = rqueue('in-progress')
             self.heartbeat = rqueue('heartbeat')
+            self.slots = rqueue('slots')
 
     class TaskRedisQueues:
         def __init__(self, prefix, id):
@@ -142,9 +227,22 @@ class RedisQueues:
     def tasks_group(self, group: str):
         return f'{self._prefix}-{group}-tasks'
 
+    def runners_group(self, group: str):
+        return f'{self._prefix}-{group}-runners'
+
+    def prefetch_group(self, group: str):
+        return f'{self._prefix}-{group}-prefetch'
+
     def runner(self, runner: RunnerInfo):
         return RedisQueues(self._prefix, runner)
 
 
+async def push_with_expiry(redis: 'Redis', queue: str, value: Any,
+                           ttl_secs: int):
+    '''lpushes value to queue and sets its ttl in a single round trip.'''
+    async with redis.pipeline(transaction=True) as pipe:
+        await pipe.lpush(queue, value).expire(queue, ttl_secs).execute()
+
+
 def format_exc(e):
     return ''.join(format_exception(e, e, e.__traceback__))
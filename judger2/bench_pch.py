@@ -0,0 +1,69 @@
+'''
+Compares the latency of compiling a typical submission with and without
+the precompiled standard headers. Run with
+    python3 -m judger2.bench_pch [runs]
+from the repository root, with a valid runner.yml.
+'''
+
+from asyncio import run
+from statistics import median
+from sys import argv
+from time import perf_counter
+
+import judger2.pch as pch
+from commons.task_typing import CompileSourceCpp, ResourceUsage
+from judger2.config import cxx_file_name
+from judger2.steps.compile_ import compile_cpp
+from judger2.util import TempDir
+
+source = '''#include <bits/stdc++.h>
+using namespace std;
+
+int main() {
+    int n;
+    cin >> n;
+    vector<long long> a(n);
+    for (auto &x : a) cin >> x;
+    sort(a.begin(), a.end());
+    cout << accumulate(a.begin(), a.end(), 0LL) << endl;
+}
+'''
+
+limits = ResourceUsage(
+    time_msecs=60000,
+    memory_bytes=2147483648,
+    file_count=-1,
+    file_size_bytes=-1,
+)
+
+
+async def time_compile(runs: int) -> float:
+    secs = []
+    for _ in range(runs):
+        with TempDir() as cwd:
+            (cwd / cxx_file_name).write_text(source)
+            start = perf_counter()
+            # compile_cpp only uses the staged source file.
+            res = await compile_cpp(cwd, CompileSourceCpp(''), limits)
+            secs.append(perf_counter() - start)
+            if res.result.result != 'compiled':
+                raise Exception(f'compile error: {res.result.message}')
+    return median(secs)
+
+
+async def main():
+    runs = int(argv[1]) if len(argv) > 1 else 10
+    await pch.prepare_std_pch()
+    if pch._pch_dir is None:
+        print('precompiled headers are not available')
+        return
+    with_pch = await time_compile(runs)
+    pch_dir, pch._pch_dir = pch._pch_dir, None
+    without_pch = await time_compile(runs)
+    pch._pch_dir = pch_dir
+    print(f'{runs} runs each, median: {with_pch * 1000:.0f} ms with '
+          f'precompiled headers, {without_pch * 1000:.0f} ms without')
+
+
+if __name__ == '__main__':
+    run(main())
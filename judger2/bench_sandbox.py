@@ -0,0 +1,209 @@
+'''
+Measures the overhead of the judger hot path: running programs through
+run_with_limits, compiling, and checking with each checker. For every
+workload, prints latency percentiles of each phase of the work. Run with
+    python3 -m judger2.bench_sandbox [iterations]
+from the repository root, with a valid runner.yml and the sandbox and
+checker built. Input files are served to the cache from a local http
+server, so that no S3 is needed.
+'''
+
+from asyncio import run
+from pathlib import PosixPath
+from sys import argv
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, List, Type
+
+from aiohttp import web
+
+from commons.task_typing import (Checker, CheckResult, CompareChecker,
+                                 CompileSourceCpp, CompileTask, DirectChecker,
+                                 ResourceUsage, SpjChecker)
+from judger2.cleanup import remove_dirs
+from judger2.sandbox import run_with_limits
+from judger2.steps.check import checker_cmp, checker_cmp_b, checkers
+from judger2.steps.compile_ import compile
+from judger2.steps.run import elf_mode
+from judger2.util import PhaseTimer, TempDir, stage_file
+
+programs = {
+    'empty': 'int main() {}',
+    'cpu': '''
+        int main() {
+            volatile unsigned long x = 0;
+            for (unsigned long i = 0; i < 200000000; ++i) x += i;
+        }''',
+    'memory': '''
+        #include <cstdlib>
+        #include <cstring>
+        int main() {
+            const size_t size = 256 << 20;
+            char *p = (char *) malloc(size);
+            memset(p, 1, size);
+            return p[size - 1] - 1;
+        }''',
+    'output': '''
+        #include <cstdio>
+        int main() {
+            for (int i = 0; i < 4000000; ++i) printf("%d\\n", i);
+        }''',
+}
+
+spj_source = '''
+    #include <cstdio>
+    int main(int argc, char **argv) {
+        FILE *score = fopen(argv[4], "w");
+        fputs("1", score);
+    }'''
+
+limits = ResourceUsage(
+    time_msecs=10000,
+    memory_bytes=536870912,
+    file_count=-1,
+    file_size_bytes=268435456,
+)
+
+
+class Files:
+    '''Serves files to the cache of the runner over http.'''
+
+    def __init__(self, dir: PosixPath):
+        self.dir = dir
+        self.base_url = ''
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_static('/', self.dir)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.base_url = f'http://{host}:{port}'
+
+    def add(self, name: str, content: str) -> str:
+        (self.dir / name).write_text(content)
+        return f'{self.base_url}/{name}'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def compile_task(url: str) -> CompileTask:
+    return CompileTask(CompileSourceCpp(url), [], None, limits)
+
+
+def percentile(secs: List[float], q: float) -> float:
+    return secs[min(len(secs) - 1, int(len(secs) * q))]
+
+def report(name: str, samples: List[Dict[str, float]]):
+    print(f'{name} ({len(samples)} runs), msecs:')
+    print(f'  {"phase":<10}{"p50":>10}{"p90":>10}{"p99":>10}')
+    phases = list(dict.fromkeys(x for sample in samples for x in sample))
+    for phase in phases:
+        secs = sorted(sample.get(phase, 0.0) for sample in samples)
+        print(f'  {phase:<10}' + ''.join(f'{percentile(secs, q) * 1000:>10.1f}'
+                                         for q in (0.5, 0.9, 0.99)))
+
+async def measure(name: str, iterations: int,
+                  work: Callable[[PhaseTimer], Awaitable[None]]):
+    samples = []
+    for _ in range(iterations):
+        phases = PhaseTimer()
+        start = perf_counter()
+        await work(phases)
+        samples.append({**phases.secs, 'total': perf_counter() - start})
+    report(name, samples)
+
+
+async def run_program(exe: PosixPath, phases: PhaseTimer):
+    '''Runs exe the way judger2.steps.run does, phase by phase.'''
+    with phases.phase('tempdir'):
+        # entered but not exited, as the dirs are removed below.
+        oufdir = TempDir().__enter__()
+        cwd = TempDir().__enter__()
+        exec_file = oufdir / 'code'
+        await stage_file(exe, exec_file, elf_mode)
+    try:
+        with open(oufdir / 'ouf', 'w') as ouf:
+            res = await run_with_limits(
+                [str(exec_file)], cwd, limits,
+                supplementary_paths=[exec_file],
+                outfile=ouf,
+                disable_stderr=True,
+            )
+        if res.error is not None:
+            raise Exception(f'{exe} failed: {res.message}')
+        for phase, secs in res.phase_secs.items():
+            phases.secs[phase] = phases.secs.get(phase, 0.0) + secs
+    finally:
+        # TempDir.__exit__ only hands the dirs to the cleanup thread; time
+        # the chown_back and rmtree that thread does for them.
+        with phases.phase('cleanup'):
+            remove_dirs([cwd, oufdir])
+
+
+async def main():
+    iterations = int(argv[1]) if len(argv) > 1 else 20
+    with TempDir() as files_dir, TempDir() as output_dir:
+        files = Files(files_dir)
+        await files.start()
+        try:
+            executables: Dict[str, PosixPath] = {}
+            for name, source in programs.items():
+                res = await compile(compile_task(files.add(f'{name}.cpp', source)))
+                if res.result.result != 'compiled' or res.local_path is None:
+                    raise Exception(f'cannot compile {name}: {res.result.message}')
+                executables[name] = res.local_path
+            for name, exe in executables.items():
+                await measure(f'run_with_limits: {name}', iterations,
+                              lambda phases: run_program(exe, phases))
+
+            # a different source (and url) every time, so that neither the
+            # file cache nor the compile cache is hit.
+            count = 0
+            async def compile_once(_phases: PhaseTimer):
+                nonlocal count
+                count += 1
+                source = f'// {count}\n{programs["empty"]}'
+                url = files.add(f'compile-{count}.cpp', source)
+                await compile(compile_task(url))
+            await measure('compile', iterations, compile_once)
+
+            answer = ''.join(f'{i}\n' for i in range(1000000))
+            output = output_dir / 'output'
+            output.write_text(answer)
+            score = output_dir / 'score'
+            score.write_text('1')
+            answer_url = files.add('answer', answer)
+            compare_checker = CompareChecker(True, answer_url)
+            cases: Dict[Type[Checker], Checker] = {
+                CompareChecker: compare_checker,
+                DirectChecker: DirectChecker(),
+                SpjChecker: SpjChecker(
+                    'checker',
+                    compile_task(files.add('spj.cpp', spj_source)),
+                    answer_url, [], limits),
+            }
+            for checker_type, check in checkers.items():
+                checker = cases[checker_type]
+                outfile = score if checker_type is DirectChecker else output
+                async def check_once(_phases: PhaseTimer):
+                    res = await check(None, outfile, output_dir, checker)
+                    if res.result != 'accepted':
+                        raise Exception(f'{checker} failed: {res.message}')
+                await measure(f'checker: {checker_type.__name__}',
+                              iterations, check_once)
+            # the comparison by itself, and as double checked in a sandbox.
+            compare: Callable[..., Awaitable[CheckResult]]
+            for name, compare in (('in process', checker_cmp),
+                                  ('sandboxed', checker_cmp_b)):
+                async def compare_once(_phases: PhaseTimer):
+                    await compare(None, output, output_dir, compare_checker)
+                await measure(f'compare: {name}', iterations, compare_once)
+        finally:
+            await files.stop()
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,58 @@
+'''
+Compares staging files into working dirs by copying them against
+stage_file, for a problem with many testpoints. Run with
+    python3 -m judger2.bench_staging [testpoints] [file size in bytes]
+from the repository root, with a valid runner.yml.
+'''
+
+from asyncio import run
+from os import chmod, urandom
+from pathlib import PosixPath
+from shutil import copy2
+from sys import argv
+from time import perf_counter
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from judger2.cache import object_mode
+from judger2.util import TempDir, elf_mode, stage_file
+
+
+async def main():
+    testpoints = int(argv[1]) if len(argv) > 1 else 1000
+    size = int(argv[2]) if len(argv) > 2 else 1048576
+    with TempDir() as src_dir:
+        # an executable and a supplementary file, as staged per testpoint
+        # by run and checker_spj: the executable is a compile artifact in
+        # the cache, and is staged with elf_mode.
+        sources: List[Tuple[PosixPath, int, Optional[int]]] = [
+            (src_dir / 'code', elf_mode, elf_mode),
+            (src_dir / 'data.txt', object_mode, None),
+        ]
+        for src, src_mode, _ in sources:
+            src.write_bytes(urandom(size))
+            src.chmod(src_mode)
+
+        async def copy(src: PosixPath, dest: PosixPath,
+                       mode: Optional[int] = None):
+            copy2(src, dest)
+            if mode is not None:
+                chmod(dest, mode)
+        stagers: List[Tuple[str, Callable[[PosixPath, PosixPath,
+                                           Optional[int]],
+                                          Awaitable[None]]]] = \
+            [('copy2', copy), ('stage_file', stage_file)]
+        for name, stage in stagers:
+            with TempDir() as dest_dir:
+                start = perf_counter()
+                for i in range(testpoints):
+                    testpoint_dir = dest_dir / str(i)
+                    testpoint_dir.mkdir()
+                    for src, _, mode in sources:
+                        await stage(src, testpoint_dir / src.name, mode)
+                elapsed = perf_counter() - start
+            print(f'{name}: {testpoints} testpoints, {len(sources)} files '
+                  f'of {size} bytes each: {elapsed * 1000:.1f} ms in total, '
+                  f'{elapsed / testpoints * 1e6:.1f} us per testpoint')
+
+if __name__ == '__main__':
+    run(main())
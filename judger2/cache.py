@@ -1,96 +1,422 @@
-from asyncio import CancelledError, sleep
-from dataclasses import dataclass
+import json
+from asyncio import CancelledError, Task, create_task, shield, sleep
+from contextlib import contextmanager
+from contextvars import Context, ContextVar
+from dataclasses import asdict, dataclass
 from datetime import datetime, timezone
+from hashlib import sha256
 from http.client import NOT_MODIFIED, OK
 from logging import getLogger
-from os import chmod, path, remove, rename, scandir, stat, utime
+from os import chmod, remove, rename, scandir
 from pathlib import PosixPath
-from shutil import copy
+from re import sub
+from shutil import copyfile, rmtree
 from time import time
-from typing import Union
+from typing import Dict, Iterator, Optional, Set, Union
 from urllib.parse import urlsplit
-from uuid import NAMESPACE_URL, uuid5
+from uuid import uuid4
 
 from aiohttp import request
 
-from commons.util import format_exc
+from commons.util import asyncrun, format_exc
 from judger2.config import (cache_clear_interval_secs, cache_dir,
-                            cache_max_age_secs)
+                            cache_fresh_secs, cache_index_flush_interval_secs,
+                            cache_max_age_secs, cache_max_bytes)
+from judger2.metrics import timed
 
 logger = getLogger(__name__)
 
 
+# Layout of the cache dir:
+#   objects/<object id>  content of cached files, stored once per content
+#   index.json           maps url paths and compile cache keys to objects,
+#                        and records the size and last use time of every
+#                        object
+#   <anything else>      files created by other modules (e.g. local compile
+#                        artifacts), removed once not touched for a while
+objects_dir = PosixPath(cache_dir) / 'objects'
+index_path = PosixPath(cache_dir) / 'index.json'
+# bare mirrors of git repos, by hash of their url; see steps/compile_.py.
+git_mirrors_dir = PosixPath(cache_dir) / 'git'
+object_mode = 0o640
+
+
 @dataclass
 class CachedFile:
     path: PosixPath
     filename: str
 
 
-def cached_from_url(url: str) -> CachedFile:
-    key = urlsplit(url).path
-    cache_id = str(uuid5(NAMESPACE_URL, key))
-    p = PosixPath(path.join(cache_dir, cache_id))
-    filename = PosixPath(key).name
-    return CachedFile(p, filename)
+@dataclass
+class UrlEntry:
+    object: str
+    # Last-Modified of the remote object, as a timestamp.
+    last_modified: float
+    etag: Optional[str] = None
+    # when the cached content was last confirmed to be up to date.
+    validated_at: float = 0.0
+
+@dataclass
+class CacheObject:
+    size: int
+    last_used: float
+
+@dataclass
+class CompileEntry:
+    # the compiled artifact.
+    object: str
+    # message of the compiler.
+    message: str
+
+@dataclass
+class CompileCacheStats:
+    hits: int = 0
+    misses: int = 0
+
+
+class CacheIndex:
+    def __init__(self):
+        self.urls: Dict[str, UrlEntry] = {}
+        self.compiled: Dict[str, CompileEntry] = {}
+        self.objects: Dict[str, CacheObject] = {}
+        self.pins: Dict[str, int] = {}
+        self.total_bytes = 0
+        self.dirty = False
+
+    def load(self):
+        objects_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            data = json.loads(index_path.read_text())
+            urls = dict((k, UrlEntry(**v)) for k, v in data['urls'].items())
+            compiled = dict((k, CompileEntry(**v))
+                            for k, v in data.get('compiled', {}).items())
+            objects = dict((k, CacheObject(**v))
+                           for k, v in data['objects'].items())
+        except FileNotFoundError:
+            urls, compiled, objects = {}, {}, {}
+        except Exception as e:
+            logger.error(f'cannot load cache index, starting afresh: {format_exc(e)}')
+            urls, compiled, objects = {}, {}, {}
+        # reconcile the index with what is actually on disk.
+        on_disk = set(x.name for x in scandir(objects_dir) if x.is_file())
+        for name in on_disk - set(objects):
+            logger.debug(f'removing unindexed cache object {name}')
+            remove(objects_dir / name)
+        self.objects = dict((k, v) for k, v in objects.items() if k in on_disk)
+        self.urls = dict((k, v) for k, v in urls.items()
+                         if v.object in self.objects)
+        self.compiled = dict((k, v) for k, v in compiled.items()
+                             if v.object in self.objects)
+        self.total_bytes = sum(x.size for x in self.objects.values())
+        self.dirty = True
+        logger.info(f'cache index loaded: {len(self.urls)} urls, '
+                    f'{len(self.compiled)} compiled, '
+                    f'{len(self.objects)} objects, {self.total_bytes} bytes')
+
+    async def save(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        text = json.dumps({
+            'urls': dict((k, asdict(v)) for k, v in self.urls.items()),
+            'compiled': dict((k, asdict(v)) for k, v in self.compiled.items()),
+            'objects': dict((k, asdict(v)) for k, v in self.objects.items()),
+        })
+        def write():
+            tmp_path = index_path.with_suffix('.tmp')
+            tmp_path.write_text(text)
+            rename(tmp_path, index_path)
+        await asyncrun(write)
+
+    def lookup(self, key: str) -> Optional[UrlEntry]:
+        return self.urls.get(key, None)
+
+    def touch(self, object_id: str):
+        self.objects[object_id].last_used = time()
+        self.dirty = True
+
+    def add_object(self, object_id: str, size: int):
+        if object_id not in self.objects:
+            self.total_bytes += size
+        self.objects[object_id] = CacheObject(size, time())
+        self.dirty = True
+
+    def set_url(self, key: str, entry: UrlEntry):
+        self.urls[key] = entry
+        self.dirty = True
+
+    def set_compiled(self, key: str, entry: CompileEntry):
+        self.compiled[key] = entry
+        self.dirty = True
+
+    def pin(self, object_id: str):
+        self.pins[object_id] = self.pins.get(object_id, 0) + 1
+
+    def unpin(self, object_id: str):
+        count = self.pins[object_id] - 1
+        if count == 0:
+            del self.pins[object_id]
+        else:
+            self.pins[object_id] = count
+
+    def remove_object(self, object_id: str):
+        obj = self.objects.pop(object_id)
+        self.total_bytes -= obj.size
+        self.urls = dict((k, v) for k, v in self.urls.items()
+                         if v.object != object_id)
+        self.compiled = dict((k, v) for k, v in self.compiled.items()
+                             if v.object != object_id)
+        self.dirty = True
+        try:
+            remove(objects_dir / object_id)
+        except FileNotFoundError:
+            pass
+
+    def evict(self, keep: Optional[str] = None):
+        '''
+        Removes least recently used objects until the cache fits in its
+        byte budget, as well as objects not used for cache_max_age_secs.
+        Pinned objects and the object `keep` are never removed.
+        '''
+        now = time()
+        for object_id, obj in sorted(self.objects.items(),
+                                     key=lambda x: x[1].last_used):
+            expired = now - obj.last_used > cache_max_age_secs
+            over_budget = cache_max_bytes is not None \
+                and self.total_bytes > cache_max_bytes
+            if not expired and not over_budget:
+                break
+            if object_id in self.pins or object_id == keep:
+                continue
+            logger.debug(f'evicting cache object {object_id} ({obj.size} bytes)')
+            self.remove_object(object_id)
+
+index = CacheIndex()
+index.load()
+
+
+# Objects used by a task are pinned until the task finishes, so that
+# eviction never removes a file a running judge is about to use.
+_pinned: ContextVar[Optional[Set[str]]] = ContextVar('pinned', default=None)
+
+@contextmanager
+def pin_scope() -> Iterator[None]:
+    pinned: Set[str] = set()
+    token = _pinned.set(pinned)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+        for object_id in pinned:
+            index.unpin(object_id)
+
+def use_object(object_id: str):
+    index.touch(object_id)
+    pinned = _pinned.get()
+    if pinned is not None and object_id not in pinned:
+        pinned.add(object_id)
+        index.pin(object_id)
+
+
+def url_key(url: str) -> str:
+    return urlsplit(url).path
+
+def cached_file(key: str, object_id: str) -> CachedFile:
+    return CachedFile(objects_dir / object_id, PosixPath(key).name)
+
+def object_id_from_etag(etag: str, size: int) -> str:
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return f'etag-{sub(r"[^0-9A-Za-z]", "", etag)}-{size}'
 
 
 utc_time_format = '%a, %d %b %Y %H:%M:%S GMT'
 
+def parse_http_date(date: str) -> float:
+    return datetime.strptime(date, utc_time_format) \
+        .replace(tzinfo=timezone.utc) \
+        .timestamp()
+
+def format_http_date(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).astimezone(timezone.utc) \
+        .strftime(utc_time_format)
+
+
+# downloads (or revalidations) in progress, by url key.
+inflight: Dict[str, 'Task[CachedFile]'] = {}
 
 async def ensure_cached(url: str) -> CachedFile:
-    cache = cached_from_url(url)
-    logger.debug(f'caching file {cache.filename} to {cache.path}')
+    '''
+    Makes sure the file at url is cached locally.
+
+    Concurrent calls for the same file share a single request, and a file
+    validated within the last cache_fresh_secs is used without asking the
+    server again.
+    '''
+    with timed('fetch'):
+        key = url_key(url)
+        entry = index.lookup(key)
+        if entry is not None and time() - entry.validated_at < cache_fresh_secs:
+            logger.debug(f'{key} was validated recently, using cache')
+            use_object(entry.object)
+            return cached_file(key, entry.object)
+        while True:
+            if key not in inflight:
+                # in a context of its own, so that the fetch does not pin
+                # into the scope of whichever caller started it, which may
+                # have exited by the time it finishes.
+                task = Context().run(create_task, fetch(url, key))
+                inflight[key] = task
+                task.add_done_callback(lambda _: inflight.pop(key, None))
+                task.add_done_callback(release_fetched)
+            # the request goes on for other callers if this one is cancelled.
+            cache = await shield(inflight[key])
+            if cache.path.name in index.objects:
+                use_object(cache.path.name)
+                return cache
+            # evicted before we got to pin it; fetch it again.
+            logger.debug(f'{key} was evicted while being fetched')
+
+def hold_fetched(object_id: str):
+    '''Keeps a fetched object from eviction until its callers pin it.'''
+    index.touch(object_id)
+    index.pin(object_id)
+
+def release_fetched(task: 'Task[CachedFile]'):
+    if not task.cancelled() and task.exception() is None:
+        index.unpin(task.result().path.name)
+
+async def fetch(url: str, key: str) -> CachedFile:
+    entry = index.lookup(key)
+    logger.debug(f'caching file {key}')
     headers = {}
-    try:
-        mtime = stat(cache.path).st_mtime
-        date = datetime.fromtimestamp(mtime).astimezone(timezone.utc)
-        utc_string = date.strftime(utc_time_format)
-        headers['If-Modified-Since'] = utc_string
-    except FileNotFoundError:
-        mtime = time()
+    if entry is not None:
+        headers['If-Modified-Since'] = format_http_date(entry.last_modified)
+        if entry.etag is not None:
+            headers['If-None-Match'] = entry.etag
     async with request('GET', url, headers=headers) as resp:
-        if resp.status == NOT_MODIFIED:
-            logger.debug(f'{cache.filename} is not modified, using cache')
-            utime(cache.path, (time(), mtime))
-            return cache
+        if resp.status == NOT_MODIFIED and entry is not None \
+        and entry.object in index.objects:
+            logger.debug(f'{key} is not modified, using cache')
+            entry.validated_at = time()
+            hold_fetched(entry.object)
+            return cached_file(key, entry.object)
         if resp.status != OK:
             raise Exception(f'Unknown response status {resp.status} while fetching object')
-        logger.debug(f'{cache.filename} is modified, downloading file')
-        part_path = cache.path.with_suffix('.part')
+        last_modified = parse_http_date(resp.headers['Last-Modified']) \
+            if 'Last-Modified' in resp.headers else time()
+        etag = resp.headers.get('ETag', None)
+        size = resp.content_length
+
+        # The same content may be published under many urls (e.g. testdata
+        # shared across problems); if it is already stored, the body need
+        # not be downloaded again.
+        object_id = None
+        if etag is not None and size is not None:
+            object_id = object_id_from_etag(etag, size)
+            if object_id in index.objects:
+                logger.debug(f'{key} has known content {object_id}')
+                index.set_url(key, UrlEntry(object_id, last_modified, etag, time()))
+                hold_fetched(object_id)
+                return cached_file(key, object_id)
+
+        logger.debug(f'{key} is modified, downloading file')
+        part_path = objects_dir / f'{uuid4()}.part'
         try:
+            digest = sha256()
+            size = 0
             with open(part_path, 'wb') as f:
                 async for data, _ in resp.content.iter_chunks():
                     f.write(data)
-            last_modified = datetime \
-                .strptime(resp.headers['Last-Modified'], utc_time_format) \
-                .replace(tzinfo=timezone.utc) \
-                .timestamp()
-            utime(part_path, (time(), last_modified))
-            rename(part_path, cache.path)
-        except CancelledError:
+                    digest.update(data)
+                    size += len(data)
+            if object_id is None:
+                object_id = f'sha256-{digest.hexdigest()}'
+            chmod(part_path, object_mode)
+            rename(part_path, objects_dir / object_id)
+        except BaseException:
             try:
                 remove(part_path)
             except Exception:
                 pass
             raise
-        return cache
+        index.add_object(object_id, size)
+        index.set_url(key, UrlEntry(object_id, last_modified, etag, time()))
+        hold_fetched(object_id)
+        index.evict(keep=object_id)
+        return cached_file(key, object_id)
 
 
-async def upload(local_path: Union[str, PosixPath], url: str) -> CachedFile:
-    cache = cached_from_url(url)
-    copy(local_path, cache.path)
-    chmod(cache.path, 0o640)
-    utime(cache.path)
-    with open(cache.path, 'rb') as f:
+def store(local_path: Union[str, PosixPath], mode: int = object_mode) -> str:
+    '''
+    Copies a local file into the cache, and returns its object id. The
+    object gets the given mode; storing a file with the mode it is staged
+    with lets stage_file hardlink it.
+    '''
+    part_path = objects_dir / f'{uuid4()}.part'
+    try:
+        copyfile(local_path, part_path)
+        chmod(part_path, mode)
+        digest = sha256()
+        size = 0
+        with open(part_path, 'rb') as f:
+            while len(data := f.read(65536)) > 0:
+                digest.update(data)
+                size += len(data)
+        object_id = f'sha256-{digest.hexdigest()}'
+        rename(part_path, objects_dir / object_id)
+    except BaseException:
+        try:
+            remove(part_path)
+        except Exception:
+            pass
+        raise
+    index.add_object(object_id, size)
+    use_object(object_id)
+    index.evict(keep=object_id)
+    return object_id
+
+async def upload_object(object_id: str, url: str) -> CachedFile:
+    '''Uploads a cached object to url, and caches it for that url.'''
+    key = url_key(url)
+    index.set_url(key, UrlEntry(object_id, time(), validated_at=time()))
+    use_object(object_id)
+    cache = cached_file(key, object_id)
+    with timed('upload'), open(cache.path, 'rb') as f:
         async with request('PUT', url, data=f) as resp:
             if resp.status != OK:
                 raise Exception(f'Unknown response status {resp.status} while uploading file')
     return cache
 
+async def upload(local_path: Union[str, PosixPath], url: str) -> CachedFile:
+    return await upload_object(store(local_path), url)
+
+
+def cache_size_bytes() -> int:
+    return index.total_bytes
+
+
+compile_cache_stats = CompileCacheStats()
+
+def lookup_compiled(key: str, count: bool = True) -> Optional[CompileEntry]:
+    entry = index.compiled.get(key, None)
+    if count:
+        if entry is None:
+            compile_cache_stats.misses += 1
+        else:
+            compile_cache_stats.hits += 1
+    if entry is not None:
+        use_object(entry.object)
+    return entry
+
+def add_compiled(key: str, object_id: str, message: str):
+    index.set_compiled(key, CompileEntry(object_id, message))
+
 
 def clear_cache():
     for file in scandir(cache_dir):
-        if not file.is_file():
+        if not file.is_file() or file.name.startswith(index_path.stem):
             continue
         st = file.stat()
         atime = max(st.st_atime, st.st_mtime)
@@ -98,14 +424,27 @@ def clear_cache():
         if age > cache_max_age_secs:
             logger.debug(f'removing file {file.path} from cache as age is {age}')
             remove(file)
+    if git_mirrors_dir.is_dir():
+        for mirror in scandir(git_mirrors_dir):
+            # mirrors are touched every time they are used.
+            age = time() - mirror.stat().st_mtime
+            if age > cache_max_age_secs:
+                logger.debug(f'removing git mirror {mirror.path} as age is {age}')
+                rmtree(mirror.path, ignore_errors=True)
 
 async def clean_cache_worker():
+    last_cleared = 0.0
     while True:
         try:
-            logger.info('clearing cache')
-            clear_cache()
+            if time() - last_cleared >= cache_clear_interval_secs:
+                logger.info('clearing cache')
+                last_cleared = time()
+                clear_cache()
+                logger.info(f'compile cache: {compile_cache_stats}')
+            index.evict()
+            await index.save()
         except CancelledError:
             return
         except Exception as e:
             logger.error(f'error while clearing cache: {format_exc(e)}')
-        await sleep(cache_clear_interval_secs)
+        await sleep(cache_index_flush_interval_secs)
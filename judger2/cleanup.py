@@ -0,0 +1,97 @@
+'''
+Removal of temp dirs off the event loop. Chowning the files the worker
+user created back to us takes an nsjail run, and removing a large output
+dir may take a while; so TempDir hands its dir to a cleanup thread, which
+chowns the dirs pending at the same time with a single nsjail run and then
+removes them. At most cleanup_max_pending dirs are queued; beyond that, a
+dir is removed right away, slowing down whoever creates them.
+'''
+
+__all__ = 'schedule_removal', 'sweep_working_dir'
+
+from logging import getLogger
+from os import scandir
+from pathlib import PosixPath
+from queue import Empty, Full, Queue
+from shutil import rmtree
+from threading import Thread
+from time import time
+from typing import List
+
+from commons.util import format_exc, remove_temp_dir
+from judger2.config import (cleanup_batch_size, cleanup_max_pending,
+                            working_dir)
+
+logger = getLogger(__name__)
+
+started_at = time()
+pending: 'Queue[PosixPath]' = Queue(maxsize=max(cleanup_max_pending, 1))
+
+
+def remove_dirs(paths: List[PosixPath]):
+    # import here to avoid circular reference
+    from judger2.sandbox import chown_back
+    # a nested temp dir may be gone with its parent already, and nsjail
+    # fails to mount a path that does not exist.
+    paths = [x for x in paths if x.exists()]
+    if len(paths) == 0:
+        return
+    try:
+        # see _judger_before_tmpdir_exit in judger2/util.py for why.
+        chown_back(*paths)
+    except Exception as e:
+        logger.warning(f'error chowning back {len(paths)} temp dirs, '
+                       f'retrying one by one: {format_exc(e)}')
+        for path in paths:
+            remove_temp_dir(path)
+        return
+    for path in paths:
+        rmtree(path, ignore_errors=True)
+
+def cleanup_worker():
+    while True:
+        paths = [pending.get()]
+        while len(paths) < cleanup_batch_size:
+            try:
+                paths.append(pending.get_nowait())
+            except Empty:
+                break
+        logger.debug(f'removing {len(paths)} temp dirs')
+        try:
+            remove_dirs(paths)
+        except Exception as e:
+            logger.error(f'error removing temp dirs: {format_exc(e)}')
+
+if cleanup_max_pending > 0:
+    Thread(target=cleanup_worker, name='tempdir-cleanup', daemon=True).start()
+
+
+def schedule_removal(path: PosixPath):
+    '''Removes the temp dir at path in the background.'''
+    if cleanup_max_pending <= 0:
+        remove_temp_dir(path)
+        return
+    try:
+        pending.put_nowait(path)
+    except Full:
+        logger.warning(f'{cleanup_max_pending} temp dirs pending removal, '
+                       f'removing {path} synchronously')
+        remove_temp_dir(path)
+
+def sweep_working_dir():
+    '''
+    Removes what previous runs of the runner left in working_dir, e.g.
+    temp dirs still pending removal when it was stopped.
+    '''
+    count = 0
+    for entry in scandir(working_dir):
+        # anything created since we started may be in use.
+        if entry.stat(follow_symlinks=False).st_mtime >= started_at:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            schedule_removal(PosixPath(entry.path))
+        else:
+            PosixPath(entry.path).unlink(missing_ok=True)
+        count += 1
+    if count > 0:
+        logger.info(f'removing {count} leftovers in {working_dir}')
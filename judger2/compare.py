@@ -0,0 +1,89 @@
+'''
+In-process output comparison, with the same semantics as
+`checker -ZB` (ignore_whitespace) and `diff -q` (otherwise).
+'''
+
+__all__ = ('compare_files',)
+
+from contextlib import contextmanager
+from mmap import ACCESS_READ, mmap
+from pathlib import PosixPath
+from typing import Iterator, Union
+
+chunk_size = 1048576
+
+
+@contextmanager
+def mapped(path: PosixPath) -> Iterator[Union[mmap, bytes]]:
+    with open(path, 'rb') as f:
+        try:
+            m = mmap(f.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped.
+            yield b''
+            return
+        with m:
+            yield m
+
+
+def common_prefix(a: Union[mmap, bytes], b: Union[mmap, bytes]) -> int:
+    '''Returns the length of the longest common prefix of a and b.'''
+    size = min(len(a), len(b))
+    pos = 0
+    while pos < size:
+        end = min(pos + chunk_size, size)
+        if a[pos:end] != b[pos:end]:
+            # narrow down the mismatch within the chunk.
+            while end - pos > 1:
+                mid = (pos + end) // 2
+                if a[pos:mid] == b[pos:mid]:
+                    pos = mid
+                else:
+                    end = mid
+            return pos
+        pos = end
+    return size
+
+
+def content_lines(data: Union[mmap, bytes], pos: int) -> Iterator[bytes]:
+    '''
+    Yields lines starting at pos, with trailing whitespace removed and
+    blank lines skipped.
+    '''
+    size = len(data)
+    while pos < size:
+        end = data.find(b'\n', pos)
+        if end < 0:
+            end = size
+        line = data[pos:end].rstrip()
+        if line != b'':
+            yield line
+        pos = end + 1
+
+
+def compare_files(path1: PosixPath, path2: PosixPath,
+                  ignore_whitespace: bool) -> bool:
+    '''
+    Compares two files, stopping at the first mismatch. Blocks, so call it
+    with asyncrun.
+    '''
+    with mapped(path1) as data1, mapped(path2) as data2:
+        if not ignore_whitespace:
+            return len(data1) == len(data2) \
+                and common_prefix(data1, data2) == len(data1)
+        # outputs are usually byte-for-byte identical to the answer, so
+        # skip the identical part quickly and only look at lines from the
+        # first difference on.
+        pos = common_prefix(data1, data2)
+        if pos == len(data1) == len(data2):
+            return True
+        pos = data1.rfind(b'\n', 0, pos) + 1
+        lines1 = content_lines(data1, pos)
+        lines2 = content_lines(data2, pos)
+        while True:
+            line1 = next(lines1, None)
+            line2 = next(lines2, None)
+            if line1 != line2:
+                return False
+            if line1 is None:
+                return True
@@ -1,4 +1,5 @@
 from shutil import which
+from typing import List, Optional
 
 from commons.task_typing import ResourceUsage
 from commons.util import RedisQueues, load_config
@@ -14,10 +15,65 @@ cache_dir: str = config['cache_dir']
 log_dir: str = config['log_dir']
 cache_max_age_secs = 86400.0
 cache_clear_interval_secs = 86400.0
+cache_index_flush_interval_secs = 60.0
+# cached files validated against S3 within this time are used directly.
+cache_fresh_secs = float(config.get('cache_fresh_secs', 30.0))
+# byte budget of the file cache, unlimited if not set.
+cache_max_bytes: Optional[int] = config.get('cache_max_bytes', None)
 worker_uid = int(config['worker_uid'])
+# max number of temp dirs queued for removal by the cleanup thread (0 to
+# remove them synchronously), and how many are chowned back at once.
+cleanup_max_pending = int(config.get('cleanup_max_pending', 256))
+cleanup_batch_size = 32
+
+# serve histograms of phase timings on localhost at this port; see
+# judger2/metrics.py.
+metrics_port: Optional[int] = config.get('metrics_port', None)
 
 heartbeat_interval_secs = 2.0
 task_timeout_secs = 3600
+# testpoints finishing within this time of the last progress update are
+# reported together in the next one.
+progress_interval_secs = float(config.get('progress_interval_secs', 0.5))
+
+# reuse the artifact of a compile task whose source, supplementary files,
+# compiler and limits are the same as an earlier one.
+compile_cache = bool(config.get('compile_cache', True))
+
+# number of tasks this runner process executes concurrently.
+slots = int(config.get('slots', 1))
+if slots < 1:
+    raise Exception(f'Invalid number of runner slots {slots}')
+
+# max number of testpoints of a task judged at the same time; testpoints
+# depending on one another, or sharing their disk space, are judged in
+# order, in the same working dir.
+testpoint_concurrency = int(config.get('testpoint_concurrency', 1))
+
+# max number of files prefetched into the cache at the same time when a
+# task starts; 0 disables prefetching. If prefetch_peek_next is set, the
+# files of the next task in the queue are prefetched as well.
+prefetch_concurrency = int(config.get('prefetch_concurrency', 4))
+prefetch_peek_next = bool(config.get('prefetch_peek_next', True))
+
+# whether to prefetch the files of problems as the scheduler updates them,
+# and the average download rate allowed for it (0 for no limit).
+prefetch_broadcast = bool(config.get('prefetch_broadcast', True))
+prefetch_broadcast_bytes_per_sec = \
+    int(config.get('prefetch_broadcast_bytes_per_sec', 8 * 1024 * 1024))
+
+# number of prepared sandbox dirs kept for reuse.
+sandbox_pool_size = int(config.get('sandbox_pool_size', 4))
+
+# pin each sandbox to a dedicated cpu; see judger2/sandbox/cpuset.py.
+cpu_pinning: Optional[dict] = config.get('cpu_pinning')
+
+# how many instructions count as a msec for problems timed by instruction
+# count; should be the same on all runners.
+instructions_per_msec = float(config.get('instructions_per_msec', 2000000))
+
+# run each sandbox in its own cgroup v2; see judger2/sandbox/cgroup.py.
+cgroup: Optional[dict] = config.get('cgroup')
 
 runner_info = RedisQueues.RunnerInfo(runner_id, runner_group)
 queues = RedisQueues(config['redis']['prefix'], runner_info)
@@ -45,6 +101,8 @@ cxx = which('g++')
 cxxflags = ['-fmax-errors=10', '-O2', '-DONLINE_JUDGE', '-std=c++20']
 cxx_file_name = 'main.cpp'
 cxx_exec_name = exec_file_name
+# standard headers precompiled at startup; see judger2/pch.py.
+cxx_pch_headers: List[str] = config.get('cxx_pch_headers', ['bits/stdc++.h'])
 
 # which('python3') does not work here inside the virtual env
 python = '/usr/bin/python3'
@@ -57,6 +115,9 @@ gitflags = [
     '--no-local',
 ]
 git_ssh_private_key = config['git']['ssh']['private_key']
+# clone git repos through bare mirrors kept under cache_dir, fetching
+# only what is new; see prepare_git in judger2/steps/compile_.py.
+git_mirror = bool(config['git'].get('mirror', True))
 
 verilog = which('iverilog')
 verilog_file_name = 'main.v'
@@ -73,7 +134,9 @@ valgrind_args = [
     '--quiet',
 ]
 
-diff = which('diff')
+# fraction of whitespace-insensitive comparisons double checked by running
+# the standalone checker in a sandbox.
+checker_ab_sample_rate = float(config.get('checker_ab_sample_rate', 0.01))
 
 checker_cmp_limits = ResourceUsage(
     time_msecs=10000,
@@ -3,25 +3,53 @@ __import__('judger2.logging_')
 from asyncio import CancelledError, create_task, run, sleep, wait
 from atexit import register
 from logging import getLogger
+from os import getloadavg
 from time import time
+from typing import List, Optional
 
-from commons.task_typing import (StatusUpdateDone, StatusUpdateError,
-                                 StatusUpdateStarted)
-from commons.util import deserialize, format_exc, serialize
+from commons.task_typing import (RunnerHeartbeat, StatusUpdateDone,
+                                 StatusUpdateError, StatusUpdateStarted)
+from commons.util import (asyncrun, deserialize, format_exc,
+                          push_with_expiry, serialize)
 
-from judger2.cache import clean_cache_worker
+from judger2.cache import (cache_size_bytes, clean_cache_worker,
+                           compile_cache_stats)
+from judger2.cleanup import sweep_working_dir
 from judger2.config import (heartbeat_interval_secs, poll_timeout_secs, queues,
-                            redis, runner_id, task_timeout_secs)
+                            redis, runner_group, runner_id, slots,
+                            task_timeout_secs)
 from judger2.logging_ import task_logger
+from judger2.metrics import serve_metrics
+from judger2.pch import prepare_std_pch
+from judger2.prefetch import prefetch_broadcasts, prefetch_next_task
 from judger2.task import run_task
 
 logger = getLogger(__name__)
 
+# id of the task running in each slot, None if the slot is idle.
+slot_tasks: List[Optional[str]] = [None] * slots
+
 
 async def send_heartbeats():
     while True:
         try:
-            await redis.set(queues.heartbeat, time())
+            heartbeat = RunnerHeartbeat(
+                time=time(),
+                slots=slots,
+                task_ids=[x for x in slot_tasks if x is not None],
+                cache_bytes=cache_size_bytes(),
+                loadavg=getloadavg()[0],
+                compile_cache_hits=compile_cache_stats.hits,
+                compile_cache_misses=compile_cache_stats.misses,
+            )
+            async with redis.pipeline(transaction=False) as pipe:
+                # the per-runner keys are still read by wait_until_offline
+                # and by schedulers predating the runners hash.
+                await pipe.mset({queues.heartbeat: heartbeat.time,
+                                 queues.slots: slots}) \
+                    .hset(queues.runners, runner_id, serialize(heartbeat)) \
+                    .sadd(queues.runner_groups, runner_group) \
+                    .execute()
         except CancelledError:
             return
         except Exception as e:
@@ -29,8 +57,7 @@ async def send_heartbeats():
         await sleep(heartbeat_interval_secs)
 
 
-async def poll_for_tasks():
-    await redis.delete(queues.in_progress)
+async def poll_for_tasks(slot: int):
     while True:
         task_id = None
         try:
@@ -40,11 +67,13 @@ async def poll_for_tasks():
                 poll_timeout_secs,
             )
             if task_id is None: continue
+            slot_tasks[slot] = task_id
+            logger.debug(f'slot {slot} picked up task {task_id}')
             task_queues = queues.task(task_id)
             async def report_progress(status):
                 logger.debug(f'reporting progress for task {task_id}: {status}')
-                await redis.lpush(task_queues.progress, serialize(status))
-                await redis.expire(task_queues.progress, task_timeout_secs)
+                await push_with_expiry(redis, task_queues.progress,
+                                       serialize(status), task_timeout_secs)
 
             task_serialized = await redis.rpop(task_queues.task)
             if task_serialized is None:
@@ -52,6 +81,9 @@ async def poll_for_tasks():
             task = deserialize(task_serialized)
             await report_progress(StatusUpdateStarted(runner_id))
             aio_task = create_task(run_task(task, task_id))
+            # kept referenced until the task is done, so that it is not
+            # garbage collected before it finishes.
+            prefetch_next = create_task(prefetch_next_task())
 
             async def poll_for_abort_signal():
                 while True:
@@ -87,6 +119,7 @@ async def poll_for_tasks():
             task_logger.error(f'error processing task: {format_exc(e)}')
             await sleep(2)
         finally:
+            slot_tasks[slot] = None
             if task_id is not None:
                 try:
                     await redis.lrem(queues.in_progress, 0, task_id)
@@ -102,10 +135,15 @@ async def poll_for_tasks():
 async def main():
     logger.info(f'runner {runner_id} starting')
     register(lambda: logger.info(f'runner {runner_id} stopping'))
+    await redis.delete(queues.in_progress)
+    await asyncrun(sweep_working_dir)
     await wait([
         create_task(send_heartbeats()),
-        create_task(poll_for_tasks()),
+        *(create_task(poll_for_tasks(slot)) for slot in range(slots)),
         create_task(clean_cache_worker()),
+        create_task(prepare_std_pch()),
+        create_task(serve_metrics()),
+        create_task(prefetch_broadcasts()),
     ])
 
 if __name__ == '__main__':
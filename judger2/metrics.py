@@ -0,0 +1,111 @@
+'''
+Timing of the phases of the work of the runner (fetching files, staging,
+compiling, running, checking, uploading). Each phase is recorded in the
+phase scope of the current testpoint or task, which ends up in its
+result, and in histograms served in the Prometheus text format on
+localhost:metrics_port at /metrics.
+'''
+
+__all__ = 'phase_scope', 'timed', 'observe', 'serve_metrics'
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging import getLogger
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional
+
+from aiohttp import web
+
+from commons.task_typing import PhaseTiming
+from judger2.config import metrics_port
+
+logger = getLogger(__name__)
+
+buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, float('inf')]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0 for _ in buckets]
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, secs: float):
+        self.counts[bisect_left(buckets, secs)] += 1
+        self.sum += secs
+        self.count += 1
+
+
+histograms: Dict[str, Histogram] = {}
+
+def observe(phase: str, secs: float):
+    '''Adds a sample to the histogram of phase.'''
+    if phase not in histograms:
+        histograms[phase] = Histogram()
+    histograms[phase].observe(secs)
+
+
+_scope: ContextVar[Optional[Dict[str, float]]] = \
+    ContextVar('phase_scope', default=None)
+
+@contextmanager
+def phase_scope() -> Iterator[List[PhaseTiming]]:
+    '''
+    Collects the phases timed in this scope (including nested ones, e.g.
+    fetching the answer while checking) into the yielded list, which is
+    filled when the scope exits.
+    '''
+    phases: Dict[str, float] = {}
+    result: List[PhaseTiming] = []
+    token = _scope.set(phases)
+    try:
+        yield result
+    finally:
+        _scope.reset(token)
+        result.extend(PhaseTiming(k, v) for k, v in phases.items())
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        secs = perf_counter() - start
+        observe(phase, secs)
+        phases = _scope.get()
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0.0) + secs
+
+
+def format_metrics() -> str:
+    lines = [
+        '# HELP judger_phase_seconds Time spent in each phase of judging.',
+        '# TYPE judger_phase_seconds histogram',
+    ]
+    for phase, histogram in sorted(histograms.items()):
+        count = 0
+        for le, n in zip(buckets, histogram.counts):
+            count += n
+            le_str = '+Inf' if le == float('inf') else str(le)
+            lines.append(f'judger_phase_seconds_bucket'
+                         f'{{phase="{phase}",le="{le_str}"}} {count}')
+        lines.append(f'judger_phase_seconds_sum{{phase="{phase}"}} '
+                     f'{histogram.sum}')
+        lines.append(f'judger_phase_seconds_count{{phase="{phase}"}} '
+                     f'{histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+async def get_metrics(_request: web.Request) -> web.Response:
+    return web.Response(text=format_metrics())
+
+async def serve_metrics():
+    if metrics_port is None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', get_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', metrics_port).start()
+    logger.info(f'serving metrics on 127.0.0.1:{metrics_port}')
@@ -0,0 +1,105 @@
+'''
+Precompiled standard headers for C++ compilation. At startup, the runner
+precompiles the headers in cxx_pch_headers with the same compiler and
+flags as user code, and compiles with `-I <pch dir>` afterwards. For each
+header, the dir holds `<header>.gch` and a wrapper `<header>` that only
+does `#include_next <header>`, so that g++ falls back to the real header
+when it cannot use the precompiled one (e.g. the header is not the first
+thing included).
+'''
+
+__all__ = 'prepare_std_pch', 'std_pch_args'
+
+import json
+from hashlib import sha256
+from logging import getLogger
+from pathlib import PosixPath
+from shutil import copyfile, rmtree
+from typing import List, Optional, Tuple
+
+from commons.task_typing import ResourceUsage
+from commons.util import TempDir, asyncrun, format_exc
+from judger2.config import cache_dir, cxx, cxx_pch_headers, cxxflags
+from judger2.sandbox import chown_back, run_with_limits
+from judger2.util import toolchain_version
+
+logger = getLogger(__name__)
+
+pch_root = PosixPath(cache_dir) / 'pch'
+pch_build_limits = ResourceUsage(
+    time_msecs=60000,
+    memory_bytes=2147483648,
+    file_count=-1,
+    file_size_bytes=-1,
+)
+
+# the dir of the precompiled headers, None if they are not ready (yet).
+_pch_dir: Optional[PosixPath] = None
+
+
+def std_pch_args() -> Tuple[List[str], List[str]]:
+    '''Returns the extra compiler flags and the paths to mount.'''
+    if _pch_dir is None:
+        return [], []
+    return ['-I', str(_pch_dir)], [str(_pch_dir)]
+
+
+def pch_key() -> str:
+    assert cxx is not None
+    ingredients = [cxx, toolchain_version(cxx, '--version'), cxxflags,
+                   cxx_pch_headers]
+    return sha256(json.dumps(ingredients).encode()).hexdigest()
+
+
+async def build_std_pch(target: PosixPath):
+    assert cxx is not None
+    part = target.with_name(f'{target.name}.part')
+    rmtree(part, ignore_errors=True)
+    for header in cxx_pch_headers:
+        with TempDir() as cwd:
+            source = cwd / 'pch.h'
+            source.write_text(f'#include <{header}>\n')
+            pch = cwd / 'pch.h.gch'
+            res = await run_with_limits(
+                [cxx] + cxxflags + ['-x', 'c++-header', str(source),
+                                    '-o', str(pch)],
+                cwd, pch_build_limits,
+                supplementary_paths=['/bin', '/usr/bin', '/usr/include'],
+            )
+            if res.error is not None or not pch.is_file():
+                raise Exception(f'cannot precompile {header}: {res.message}')
+            chown_back(cwd)
+            wrapper = part / header
+            wrapper.parent.mkdir(parents=True, exist_ok=True)
+            wrapper.write_text(f'#include_next <{header}>\n')
+            await asyncrun(lambda: copyfile(pch, f'{wrapper}.gch'))
+    # precompiled standard headers are not secret, and must be readable by
+    # the compiler in the sandbox.
+    for path in [part, *part.rglob('*')]:
+        path.chmod(0o755 if path.is_dir() else 0o644)
+    part.rename(target)
+
+
+async def prepare_std_pch():
+    '''
+    Builds the precompiled headers, unless those built with the current
+    compiler and flags are already there. Compilations started before this
+    finishes do not use them.
+    '''
+    global _pch_dir
+    if len(cxx_pch_headers) == 0 or cxx is None:
+        return
+    try:
+        key = pch_key()
+        pch_root.mkdir(parents=True, exist_ok=True)
+        for path in pch_root.iterdir():
+            if path.name != key:
+                rmtree(path, ignore_errors=True)
+        target = pch_root / key
+        if not target.is_dir():
+            logger.info(f'precompiling {", ".join(cxx_pch_headers)}')
+            await build_std_pch(target)
+        _pch_dir = target
+        logger.info(f'compiling with precompiled headers in {target}')
+    except Exception as e:
+        logger.warning(f'not using precompiled headers: {format_exc(e)}')
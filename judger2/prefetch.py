@@ -0,0 +1,165 @@
+'''
+Prefetching of the files a task needs into the cache, so that fetching
+them is off the critical path of judging testpoints. When a judge task
+starts, all urls it references are fetched in testpoint order; and the
+next task in the queue of the group is peeked at and warmed up as well.
+When a problem is updated, the scheduler may also publish the urls of its
+files to the group, which are then fetched one by one in the background.
+'''
+
+__all__ = 'prefetch_task', 'prefetch_next_task', 'prefetch_broadcasts'
+
+from asyncio import Queue, Semaphore, gather, sleep
+from logging import getLogger
+from time import monotonic
+from typing import Iterator, List
+
+from commons.task_typing import (Artifact, Checker, CompareChecker,
+                                 CompileSourceCpp, CompileSourceVerilog,
+                                 CompileTask, Input, JudgeTask,
+                                 PrefetchRequest, SpjChecker, Url)
+from commons.util import deserialize, format_exc
+from judger2.cache import ensure_cached, index, url_key
+from judger2.config import (prefetch_broadcast,
+                            prefetch_broadcast_bytes_per_sec,
+                            prefetch_concurrency, prefetch_peek_next, queues,
+                            redis)
+
+logger = getLogger(__name__)
+
+
+def input_urls(input: Input) -> Iterator[Url]:
+    if isinstance(input, Artifact):
+        yield input.url
+        return
+    if isinstance(input.source, (CompileSourceCpp, CompileSourceVerilog)):
+        yield input.source.main
+    yield from input.supplementary_files
+
+def checker_urls(checker: Checker) -> Iterator[Url]:
+    if isinstance(checker, CompareChecker):
+        # with a digest, the answer is only needed for wrong outputs.
+        if checker.answer_digest is None:
+            yield checker.answer
+    elif isinstance(checker, SpjChecker):
+        yield from input_urls(checker.executable)
+        if checker.answer is not None:
+            yield checker.answer
+        yield from checker.supplementary_files
+
+def task_urls(task: JudgeTask[Input]) -> List[Url]:
+    '''Returns the urls referenced by task, in the order they are used.'''
+    urls: List[Url] = []
+    for testpoint in task.testpoints:
+        urls.extend(input_urls(testpoint.input))
+        if testpoint.run is not None:
+            if testpoint.run.infile is not None:
+                urls.append(testpoint.run.infile)
+            urls.extend(testpoint.run.supplementary_files)
+        urls.extend(checker_urls(testpoint.check))
+    return list(dict.fromkeys(urls))
+
+
+async def prefetch(urls: List[Url], concurrency: int):
+    semaphore = Semaphore(concurrency)
+    async def fetch(url: Url):
+        async with semaphore:
+            try:
+                await ensure_cached(url)
+            except Exception as e:
+                # reported when the file is actually needed.
+                logger.debug(f'cannot prefetch {url}: {e}')
+    await gather(*map(fetch, urls))
+
+async def prefetch_task(task: JudgeTask[Input]):
+    '''
+    Caches the files of task. Should be run in the pin scope of the task,
+    so that what is prefetched is not evicted before it is used.
+    '''
+    if prefetch_concurrency <= 0:
+        return
+    await prefetch(task_urls(task), prefetch_concurrency)
+
+async def prefetch_next_task():
+    '''Caches the files of the task next in the queue, if any.'''
+    if prefetch_concurrency <= 0 or not prefetch_peek_next:
+        return
+    try:
+        # tasks are taken from the right end of the queue.
+        task_id = await redis.lindex(queues.tasks, -1)
+        if task_id is None:
+            return
+        task_serialized = await redis.lindex(queues.task(task_id).task, 0)
+        if task_serialized is None:
+            return
+        task = deserialize(task_serialized)
+        if isinstance(task, CompileTask):
+            urls = list(input_urls(task))
+        else:
+            urls = task_urls(task)
+    except Exception as e:
+        logger.debug(f'cannot peek at the next task: {e}')
+        return
+    logger.debug(f'prefetching {len(urls)} files of task {task_id}')
+    # leave most of the bandwidth to the running tasks.
+    await prefetch(urls, max(1, prefetch_concurrency // 2))
+
+
+async def prefetch_throttled(urls: List[Url], bytes_per_sec: int):
+    '''
+    Caches the files at urls one at a time, downloading at most about
+    bytes_per_sec on average (no limit if 0).
+    '''
+    for url in urls:
+        entry = index.lookup(url_key(url))
+        start = monotonic()
+        try:
+            file = await ensure_cached(url)
+        except Exception as e:
+            logger.debug(f'cannot prefetch {url}: {e}')
+            continue
+        if bytes_per_sec <= 0:
+            continue
+        # nothing was downloaded if the cached content is still valid.
+        if entry is not None and entry.object == file.path.name:
+            continue
+        delay = file.path.stat().st_size / bytes_per_sec - (monotonic() - start)
+        if delay > 0:
+            await sleep(delay)
+
+async def prefetch_broadcasts():
+    '''
+    Listens for prefetch requests published to the group of the runner,
+    and caches the files of each in turn.
+    '''
+    if not prefetch_broadcast:
+        return
+    requests: 'Queue[PrefetchRequest]' = Queue()
+    async def worker():
+        while True:
+            request = await requests.get()
+            logger.info(f'prefetching {len(request.urls)} files of problem '
+                        f'{request.problem_id}')
+            try:
+                await prefetch_throttled(request.urls,
+                                         prefetch_broadcast_bytes_per_sec)
+                logger.info(f'prefetched files of problem '
+                            f'{request.problem_id}')
+            except Exception as e:
+                logger.error(f'error prefetching files of problem '
+                             f'{request.problem_id}: {format_exc(e)}')
+    async def listen():
+        while True:
+            try:
+                async with redis.pubsub(ignore_subscribe_messages=True) \
+                as pubsub:
+                    await pubsub.subscribe(queues.prefetch)
+                    async for message in pubsub.listen():
+                        request = deserialize(message['data'])
+                        if isinstance(request, PrefetchRequest):
+                            requests.put_nowait(request)
+            except Exception as e:
+                logger.error(f'error listening for prefetch requests: '
+                             f'{format_exc(e)}')
+                await sleep(2)
+    await gather(worker(), listen())
@@ -1,27 +1,34 @@
 __all__ = 'run_with_limits', 'chown_back'
 
 from asyncio import create_subprocess_exec, wait_for
+from contextlib import asynccontextmanager, contextmanager
 from dataclasses import asdict, dataclass, field
 from logging import getLogger
 from math import ceil
 from os import (WEXITSTATUS, WIFEXITED, WIFSIGNALED, WTERMSIG, getuid,
-                strerror, wait4)
+                sched_setaffinity, strerror, wait4)
 from pathlib import PosixPath
 from shlex import quote
 from shutil import which
 from signal import strsignal
-from subprocess import DEVNULL, PIPE, Popen
+from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired
 from sys import platform
 from time import time
-from typing import (IO, Any, Callable, Coroutine, List, Optional, Sequence,
-                    Union)
+from typing import (IO, Any, AsyncIterator, Callable, Coroutine, Iterator,
+                    List, Optional, Sequence, Tuple, Union)
 
 from typing_extensions import Literal
 
-from commons.task_typing import ResourceUsage, RunResult
+from commons.task_typing import ResourceUsage, RunResult, TimeMetric
 from commons.util import asyncrun
-from judger2.config import relative_slowness, task_envp, worker_uid
-from judger2.util import TempDir, format_args
+from judger2.config import (cgroup, cpu_pinning, instructions_per_msec,
+                            relative_slowness, sandbox_pool_size, task_envp,
+                            worker_uid)
+from judger2.sandbox.cgroup import Cgroup, CgroupManager, CgroupUsage
+from judger2.sandbox.cpuset import CpuAllocator
+from judger2.sandbox.diskusage import disk_usage
+from judger2.sandbox.pool import SandboxPool
+from judger2.util import PhaseTimer, format_args
 
 logger = getLogger(__name__)
 
@@ -44,6 +51,11 @@ worker_uid_maps = [
     f'{worker_uid_inside}:{worker_uid}:1', # map worker
 ]
 
+cpu_allocator = CpuAllocator.from_config(cpu_pinning)
+cgroup_manager = CgroupManager.from_config(cgroup)
+sandbox_pool = SandboxPool(sandbox_pool_size)
+sandbox_pool.prewarm()
+
 def waitstatus_to_exitcode (status):
     if WIFEXITED(status):
         return WEXITSTATUS(status)
@@ -73,14 +85,16 @@ class NsjailArgs:
 
     # maximum size in megabytes of files that the process may create.
     rlimit_fsize: str = 'inf'
-    # cgroup-based memory limit: not working.
-    # cgroup_mem_max: str
+    # nsjail's own cgroup support is not used, as the cgroup is removed
+    # before we could read the usage; see cgroup.py instead.
 
     # whether to enable network access in the container.
     disable_clone_newnet: bool = False
 
     mode: str = 'o'
     really_quiet: bool = True
+    # nsjail picks the cpu from the affinity mask it inherits, so pinning
+    # is done by setting the affinity of the nsjail process itself.
     max_cpus: str = '1'
     rlimit_stack: str = 'inf'
     # capabilities(7) to grant to the program.
@@ -97,6 +111,52 @@ class NsjailArgs:
 
 
 time_tolerance_ratio = 1.25
+# when the time limit is not on real time, the wall clock only stops
+# programs that sleep or wait forever, so it can be far more generous.
+wall_time_ratio_cputime = 3.0
+
+du_path = str(PosixPath(__file__).with_name('du'))
+
+async def du_in_sandbox(cwd: PosixPath) -> Tuple[int, int]:
+    '''
+    Runs the patched du inside a sandbox, which can read directories
+    created by the sandboxed program with restrictive modes. Returns the
+    disk usage in KiB and the number of files.
+    '''
+    du_proc = await create_subprocess_exec(
+        nsjail,
+        *format_args(asdict(NsjailArgs('/', str(cwd), '9.0'))),
+        '--', du_path, '-s',
+        stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+        limit=4096,
+    )
+    du_code = await wait_for(du_proc.wait(), 10.0)
+    if du_code != 0:
+        raise Exception(f'du exited with code {du_code}')
+    assert du_proc.stdout is not None
+    du_out = (await du_proc.stdout.read(4096)).decode(errors='replace') \
+        .split('\n')
+    file_size_kbytes, file_count = [int(x) for x in du_out[:2]]
+    return file_size_kbytes, file_count
+
+@contextmanager
+def sandbox_cgroup(memory_limit_bytes: int) -> Iterator[Optional[Cgroup]]:
+    if cgroup_manager is None:
+        yield None
+        return
+    cg = cgroup_manager.create(memory_limit_bytes)
+    try:
+        yield cg
+    finally:
+        cg.remove()
+
+@asynccontextmanager
+async def pinned_cpu(enabled: bool = True) -> AsyncIterator[Optional[int]]:
+    if cpu_allocator is None or not enabled:
+        yield None
+        return
+    async with cpu_allocator.allocate() as cpu:
+        yield cpu
 
 async def run_with_limits(
     argv: List[str],
@@ -113,109 +173,144 @@ async def run_with_limits(
     disable_stderr: bool = False,
     env: List[str] = [],
     setup_root_dir: Optional[Callable[[PosixPath], Coroutine[Any, Any, None]]] = None,
+    timing: TimeMetric = 'realtime',
+    after_spawn: Optional[Callable[[Popen], None]] = None,
+    pin_cpu: bool = True,
 ) -> RunResult:
     # these are nsjail args
     fsize = 'inf' if limits.file_size_bytes < 0 else \
         str(ceil(limits.file_size_bytes / 1048576 + 256))
     time_limit_scaled = limits.time_msecs * relative_slowness
-    time_limit_nsjail = str(ceil(time_limit_scaled / 1000 * time_tolerance_ratio + 1))
+    wall_ratio = 1.0 if timing == 'realtime' else wall_time_ratio_cputime
+    time_limit_wall = time_limit_scaled * wall_ratio
+    time_limit_nsjail = str(ceil(time_limit_wall / 1000 * time_tolerance_ratio + 1))
     # memory_limit = str(limits.memory_bytes + 1048576)
     bindmount_ro = bindmount_ro_base + [str(x) for x in supplementary_paths]
     bindmount_rw = bindmount_rw_base + [str(cwd)] \
         + [str(x) for x in supplementary_paths_rw]
-    # get the absolute path for ./runner and ./du
+    # get the absolute path for ./runner
     runner_path = str(PosixPath(__file__).with_name('runner'))
-    du_path = str(PosixPath(__file__).with_name('du'))
 
-    with TempDir() as tmp_dir, open(tmp_dir / 'stderr', 'w+b') as errfile:
-        # make needed files and dirs
-        tmp_dir.chmod(0o700)
-        chroot = tmp_dir / 'root'
-        chroot.mkdir(0o750)
+    phases = PhaseTimer()
+    # sandboxes with a custom root dir cannot be reused.
+    with sandbox_pool.use(setup_root_dir is None, phases) as sandbox, \
+         open(sandbox.stderr, 'w+b') as errfile:
+        chroot = sandbox.chroot
         if setup_root_dir is not None:
             await setup_root_dir(chroot)
-        result_dir = tmp_dir / 'result'
-        result_dir.mkdir(0o700)
-        result_file = result_dir / 'result'
+        result_dir = sandbox.result_dir
+        result_file = sandbox.result_file
 
         # construct nsjail args
-        args = NsjailArgs(
-            chroot=str(chroot),
-            cwd=str(cwd),
-            rlimit_fsize=fsize,
-            time_limit=time_limit_nsjail,
-            rlimit_cpu=str(ceil(float(time_limit_nsjail) + 1)),
-            # cgroups-based memory limit is not working
-            # cgroup_mem_max=memory_limit,
-            bindmount_ro=bindmount_ro,
-            bindmount=[str(result_dir)] + bindmount_rw,
-            disable_clone_newnet=network_access,
-            disable_proc=disable_proc,
-            tmpfsmount='/tmp' if tmpfsmount else False,
-            env=task_envp + env,
-        )
-        checker_time_limit = str(ceil(time_limit_scaled * time_tolerance_ratio + 500))
-        run_args = [runner_path, checker_time_limit, str(result_file)] \
-            + argv
-        nsjail_argv = format_args(asdict(args)) + ['--'] + run_args
-        argv_str = ' '.join(quote(x) for x in nsjail_argv)
-        logger.debug(f'about to run nsjail with args {argv_str}')
+        with phases.phase('setup'):
+            args = NsjailArgs(
+                chroot=str(chroot),
+                cwd=str(cwd),
+                rlimit_fsize=fsize,
+                time_limit=time_limit_nsjail,
+                rlimit_cpu=str(ceil(float(time_limit_nsjail) + 1)),
+                # memory is limited by the cgroup if there is one.
+                rlimit_as='inf' if cgroup_manager is not None else '1536',
+                bindmount_ro=bindmount_ro,
+                bindmount=[str(result_dir)] + bindmount_rw,
+                disable_clone_newnet=network_access,
+                disable_proc=disable_proc,
+                tmpfsmount='/tmp' if tmpfsmount else False,
+                env=task_envp + env,
+            )
+            checker_time_limit = str(ceil(time_limit_wall * time_tolerance_ratio + 500))
+            run_args = [runner_path, checker_time_limit, str(result_file)] \
+                + argv
+            nsjail_argv = format_args(asdict(args)) + ['--'] + run_args
+            argv_str = ' '.join(quote(x) for x in nsjail_argv)
+            logger.debug(f'about to run nsjail with args {argv_str}')
 
         # execute
-        time_start = time()
-        proc = Popen(
-            [nsjail] + nsjail_argv,
-            stdin=infile, stdout=outfile,
-            stderr=DEVNULL if disable_stderr else errfile,
-        )
-        _, status, rusage = await asyncrun(lambda: wait4(proc.pid, 0))
-        code = waitstatus_to_exitcode(status)
-        approx_time = time() - time_start
-        approx_mem = rusage.ru_maxrss * 1024
+        cg_usage: Optional[CgroupUsage] = None
+        async with pinned_cpu(pin_cpu) as cpu:
+            with sandbox_cgroup(limits.memory_bytes) as cg:
+                def preexec():
+                    if cpu is not None:
+                        sched_setaffinity(0, [cpu])
+                    if cg is not None:
+                        cg.attach_self()
+                time_start = time()
+                with phases.phase('spawn'):
+                    proc = Popen(
+                        [nsjail] + nsjail_argv,
+                        stdin=infile, stdout=outfile,
+                        stderr=DEVNULL if disable_stderr else errfile,
+                        preexec_fn=None if cpu is None and cg is None \
+                            else preexec,
+                    )
+                    if after_spawn is not None:
+                        after_spawn(proc)
+                with phases.phase('run'):
+                    _, status, rusage = await asyncrun(lambda: wait4(proc.pid, 0))
+                code = waitstatus_to_exitcode(status)
+                approx_time = time() - time_start
+                approx_mem = rusage.ru_maxrss * 1024
+                if cg is not None:
+                    cg_usage = cg.usage()
         logger.debug(f'nsjail run finished')
-        logger.debug(f'{code=} {approx_time=} {approx_mem=}')
+        logger.debug(f'{code=} {approx_time=} {approx_mem=} {cpu=} {cg_usage=}')
+        if cg_usage is not None and cg_usage.memory_peak_bytes is not None:
+            # includes nsjail, but is far closer than the rusage of nsjail.
+            approx_mem = cg_usage.memory_peak_bytes
+        logger.debug(f'sandbox phases so far: {phases.secs}')
 
         # parse result file
-        try:
-            text = result_file.read_text(errors='replace').replace('\n', '')
-            # 'run' code realtime mem
-            params = text.split(' ')
-            if len(params) < 4 or params[0] != 'run':
-                logger.error(f'invalid runner output {repr(text)}')
-                raise Exception('Invalid runner output')
-            program_code, realtime, mem = [int(x) for x in params[1:4]]
-            usage_is_accurate = True
-        except Exception:
-            program_code = -1
-            realtime = int(approx_time * 1000)
-            mem = int(approx_mem)
-            usage_is_accurate = False
-
-        du_proc = await create_subprocess_exec(
-            nsjail,
-            *format_args(asdict(NsjailArgs('/', str(cwd), '9.0'))),
-            '--', du_path, '-s',
-            stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
-            limit=4096,
-        )
-        du_code = await wait_for(du_proc.wait(), 10.0)
-        if du_code != 0:
-            raise Exception(f'du exited with code {du_code}')
-        assert du_proc.stdout is not None
-        du_out = (await du_proc.stdout.read(4096)).decode(errors='replace') \
-            .split('\n')
-        file_size_bytes, file_count = [int(x) for x in du_out[:2]]
-        # empty directories could still use disk storage on some FSs.
-        # let's ignore them.
-        if file_count == 0 and file_size_bytes < 16:
-            file_size_bytes = 0
-        file_size_bytes *= 1024
+        with phases.phase('parse'):
+            try:
+                text = result_file.read_text(errors='replace').replace('\n', '')
+                # 'run' code realtime mem [cputime instructions]
+                params = text.split(' ')
+                if len(params) < 4 or params[0] != 'run':
+                    logger.error(f'invalid runner output {repr(text)}')
+                    raise Exception('Invalid runner output')
+                program_code, realtime, mem = [int(x) for x in params[1:4]]
+                # older runners only report the first three numbers.
+                cputime = int(params[4]) if len(params) > 4 else None
+                instructions = int(params[5]) if len(params) > 5 else -1
+                usage_is_accurate = True
+            except Exception:
+                program_code = -1
+                realtime = int(approx_time * 1000)
+                mem = int(approx_mem)
+                cputime = None
+                instructions = -1
+                usage_is_accurate = False
+            if cputime is None and cg_usage is not None:
+                cputime = cg_usage.cpu_time_msecs
+            # the time compared against the limit, fall back to cpu time
+            # if hardware counters are unavailable.
+            if timing == 'instructions' and instructions >= 0:
+                time_msecs = instructions / instructions_per_msec
+            elif timing != 'realtime' and cputime is not None:
+                time_msecs = cputime / relative_slowness
+            else:
+                time_msecs = realtime / relative_slowness
+
+        with phases.phase('du'):
+            du_res = await asyncrun(lambda: disk_usage(cwd))
+            if du_res is None:
+                logger.debug(f'cannot scan {cwd}, running du in sandbox')
+                du_res = await du_in_sandbox(cwd)
+            file_size_bytes, file_count = du_res
+            # empty directories could still use disk storage on some FSs.
+            # let's ignore them.
+            if file_count == 0 and file_size_bytes < 16:
+                file_size_bytes = 0
+            file_size_bytes *= 1024
 
         usage = ResourceUsage(
-            time_msecs=int(realtime / relative_slowness),
+            time_msecs=int(time_msecs),
             memory_bytes=mem,
             file_count=file_count,
             file_size_bytes=file_size_bytes,
+            cpu_time_msecs=None if cputime is None else \
+                int(cputime / relative_slowness),
+            instructions=None if instructions < 0 else instructions,
         )
         errfile.seek(0)
         err = '' if disable_stderr else \
@@ -226,26 +321,33 @@ async def run_with_limits(
         errmsg = '' if err == '' else f': {err}'
 
         # check for errors
-        if usage_is_accurate and realtime > time_limit_scaled \
-        or approx_time * 1000 > time_limit_scaled + 500:
+        if usage_is_accurate and (time_msecs > limits.time_msecs
+                                  or realtime > time_limit_wall) \
+        or approx_time * 1000 > time_limit_wall + 500:
             # Check needed here as some TLE'd programs end
             # up being kill -9'd by nsjail; the real time
             # won't be accurate in this case. Therefore,
             # do not move this check down after the check
             # for exit code.
-            return RunResult('time_limit_exceeded', '', usage)
-        if usage_is_accurate and mem > limits.memory_bytes:
-            return RunResult('memory_limit_exceeded', '', usage)
+            return RunResult('time_limit_exceeded', '', usage, cpu=cpu,
+                             phase_secs=phases.secs)
+        if cg_usage is not None and cg_usage.oom_killed \
+        or usage_is_accurate and mem > limits.memory_bytes:
+            return RunResult('memory_limit_exceeded', '', usage, cpu=cpu,
+                             phase_secs=phases.secs)
         if code != 0:
             # code is ./runner's exit code, so there must be something wrong.
             msg = f'Task runner exited with status {code}{errmsg}'
-            return RunResult('system_error', msg, usage, code=code)
+            return RunResult('system_error', msg, usage, code=code, cpu=cpu,
+                             phase_secs=phases.secs)
         if file_size_bytes > limits.file_size_bytes >= 0:
             msg = 'File size too large'
-            return RunResult('disk_limit_exceeded', msg, usage)
+            return RunResult('disk_limit_exceeded', msg, usage, cpu=cpu,
+                             phase_secs=phases.secs)
         if file_count > limits.file_count >= 0:
             msg = 'Too many files are created'
-            return RunResult('disk_limit_exceeded', msg, usage)
+            return RunResult('disk_limit_exceeded', msg, usage, cpu=cpu,
+                             phase_secs=phases.secs)
         if program_code != 0:
             # runner exited properly, but the program did not
             if program_code >= 512:
@@ -263,32 +365,39 @@ async def run_with_limits(
                 msg = f'Program quit abnormally{errmsg}'
             else:
                 msg = f'Program exited with status {program_code}{errmsg}'
-            return RunResult('runtime_error', msg, usage, code=program_code)
+            return RunResult('runtime_error', msg, usage, code=program_code,
+                             cpu=cpu, phase_secs=phases.secs)
 
         # done
-        return RunResult(None, err, usage)
+        return RunResult(None, err, usage, cpu=cpu, phase_secs=phases.secs)
 
 
 chown = which('chown')
 assert chown is not None
 chown: str
 
-def chown_back(path: Union[PosixPath, str]):
-    logger.debug(f'about to chown_back {path}')
-    cwd = PosixPath(path)
-    if not cwd.is_dir():
-        cwd = cwd.parent
+def chown_back(*paths: Union[PosixPath, str]):
+    '''Chowns paths (recursively) back to us, with a single nsjail run.'''
+    logger.debug(f'about to chown_back {", ".join(map(str, paths))}')
+    dirs = [PosixPath(x) if PosixPath(x).is_dir() else PosixPath(x).parent
+            for x in paths]
     argv: List[str] = [nsjail] + format_args({
-        'cwd': str(cwd),
+        'cwd': str(dirs[0]),
         'chroot': '/',
         'uid_mapping': worker_uid_maps,
         'group': '0',
         'cap': 'CAP_CHOWN',
         'really_quiet': True,
-        'bindmount': str(cwd),
-    }) + ['--', chown, '-R', 'root', str(path)]
-    Popen(argv, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL) \
-        .wait(timeout=10.0)
+        'bindmount': list(dict.fromkeys(map(str, dirs))),
+    }) + ['--', chown, '-R', 'root', *map(str, paths)]
+    proc = Popen(argv, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+    try:
+        proc.wait(timeout=10.0 * len(paths))
+    except TimeoutExpired:
+        # the files must not be removed while chown is still running.
+        proc.kill()
+        proc.wait()
+        raise
 
 def chown_to_user(path: Union[PosixPath, str]):
     logger.debug(f'about to chown_to_user {path}')
@@ -0,0 +1,128 @@
+__all__ = 'Cgroup', 'CgroupManager', 'CgroupUsage'
+
+from dataclasses import dataclass
+from logging import getLogger
+from os import rmdir, write
+from pathlib import PosixPath
+from typing import Optional
+from uuid import uuid4
+
+logger = getLogger(__name__)
+
+
+@dataclass
+class CgroupUsage:
+    # memory.peak, None if the kernel does not provide it (before 5.19).
+    memory_peak_bytes: Optional[int]
+    cpu_time_msecs: int
+    oom_killed: bool
+
+
+def read_keyed(path: PosixPath) -> dict:
+    '''Reads a flat keyed file such as cpu.stat or memory.events.'''
+    result = {}
+    for line in path.read_text().splitlines():
+        key, value = line.split(' ', 1)
+        result[key] = int(value)
+    return result
+
+
+class Cgroup:
+    '''A cgroup v2 the sandbox of a single run is placed in.'''
+
+    def __init__(self, path: PosixPath):
+        self.path = path
+        self.path.mkdir()
+        # opened before fork, so that the child only needs a write(2).
+        self._procs = open(self.path / 'cgroup.procs', 'wb', buffering=0)
+
+    def limit(self, memory_bytes: Optional[int], cpu_max: Optional[str]):
+        if memory_bytes is not None:
+            (self.path / 'memory.max').write_text(str(memory_bytes))
+            try:
+                (self.path / 'memory.swap.max').write_text('0')
+            except FileNotFoundError:
+                pass
+            # kill the whole sandbox on OOM, not only the largest process.
+            (self.path / 'memory.oom.group').write_text('1')
+        if cpu_max is not None:
+            (self.path / 'cpu.max').write_text(cpu_max)
+
+    def attach_self(self):
+        '''
+        Moves the calling process into the cgroup. To be called in the
+        child between fork and exec (i.e. in preexec_fn).
+        '''
+        write(self._procs.fileno(), b'0')
+
+    def usage(self) -> CgroupUsage:
+        try:
+            peak = int((self.path / 'memory.peak').read_text())
+        except FileNotFoundError:
+            peak = None
+        cpu_usecs = read_keyed(self.path / 'cpu.stat')['usage_usec']
+        events = read_keyed(self.path / 'memory.events')
+        return CgroupUsage(peak, cpu_usecs // 1000, events.get('oom_kill', 0) > 0)
+
+    def remove(self):
+        self._procs.close()
+        try:
+            # kill anything left behind, as a cgroup with processes cannot
+            # be removed.
+            (self.path / 'cgroup.kill').write_text('1')
+        except OSError:
+            pass
+        try:
+            rmdir(self.path)
+        except OSError as e:
+            logger.warning(f'cannot remove cgroup {self.path}: {e}')
+
+
+class CgroupManager:
+    '''
+    Creates a cgroup under a delegated cgroup v2 subtree for each sandbox
+    run, so that memory and cpu limits are enforced by the kernel and the
+    usage of the whole sandbox can be read back precisely.
+    '''
+
+    def __init__(self, root: PosixPath, memory_margin_bytes: int,
+                 cpu_quota: Optional[float]):
+        self.root = root
+        self.memory_margin_bytes = memory_margin_bytes
+        self.cpu_max = None if cpu_quota is None else \
+            f'{int(cpu_quota * 100000)} 100000'
+        # remove cgroups left behind by a previous run of the runner.
+        for path in self.root.glob('run-*'):
+            try:
+                rmdir(path)
+            except OSError as e:
+                logger.warning(f'cannot remove stale cgroup {path}: {e}')
+        (self.root / 'cgroup.subtree_control').write_text('+memory +cpu')
+        logger.info(f'sandboxes will run in cgroups under {self.root}')
+
+    def create(self, memory_limit_bytes: int) -> Cgroup:
+        cgroup = Cgroup(self.root / f'run-{uuid4()}')
+        try:
+            memory_max = None if memory_limit_bytes < 0 else \
+                memory_limit_bytes + self.memory_margin_bytes
+            cgroup.limit(memory_max, self.cpu_max)
+        except BaseException:
+            cgroup.remove()
+            raise
+        return cgroup
+
+    @staticmethod
+    def from_config(config: Optional[dict]) -> Optional['CgroupManager']:
+        if config is None or not config.get('enabled', False):
+            return None
+        root = PosixPath(config.get('root', '/sys/fs/cgroup/judger/sandbox'))
+        try:
+            return CgroupManager(
+                root,
+                int(config.get('memory_margin_bytes', 67108864)),
+                config.get('cpu_quota', None),
+            )
+        except OSError as e:
+            logger.warning(f'cgroup v2 at {root} is not usable, '
+                           f'falling back to rlimits: {e}')
+            return None
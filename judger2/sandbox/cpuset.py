@@ -0,0 +1,81 @@
+__all__ = 'CpuAllocator', 'parse_cpu_list'
+
+from asyncio import Condition
+from contextlib import asynccontextmanager
+from logging import getLogger
+from os import sched_getaffinity
+from pathlib import PosixPath
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+logger = getLogger(__name__)
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    '''Parses a cpu list in the format of cpuset(7), e.g. "0-3,8,10-11".'''
+    cpus: List[int] = []
+    for part in text.strip().split(','):
+        if part == '':
+            continue
+        if '-' in part:
+            begin, end = part.split('-', 1)
+            cpus.extend(range(int(begin), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def thread_siblings(cpu: int) -> List[int]:
+    path = PosixPath(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list')
+    try:
+        return parse_cpu_list(path.read_text())
+    except (OSError, ValueError):
+        return [cpu]
+
+
+class CpuAllocator:
+    '''
+    Hands out a dedicated cpu to each sandbox.
+
+    Cpus are grouped into allocation units. When SMT siblings are
+    reserved, a unit is a physical core: only its first hyperthread is
+    handed out while the others are kept idle, so that sandboxes never
+    share execution units. Otherwise, every cpu is a unit by itself.
+    '''
+
+    def __init__(self, cpus: List[int], reserve_smt_siblings: bool):
+        units: Dict[int, List[int]] = {}
+        for cpu in sorted(set(cpus)):
+            siblings = thread_siblings(cpu) if reserve_smt_siblings else [cpu]
+            key = min(siblings)
+            units.setdefault(key, []).append(cpu)
+        self.cpus = [unit[0] for unit in units.values()]
+        self._free: Set[int] = set(self.cpus)
+        self._cond: Optional[Condition] = None
+        logger.info(f'sandboxes will be pinned to cpus {self.cpus}')
+
+    @asynccontextmanager
+    async def allocate(self) -> AsyncIterator[int]:
+        if self._cond is None:
+            # created lazily so that it binds to the running event loop.
+            self._cond = Condition()
+        async with self._cond:
+            await self._cond.wait_for(lambda: len(self._free) > 0)
+            cpu = min(self._free)
+            self._free.remove(cpu)
+        try:
+            yield cpu
+        finally:
+            async with self._cond:
+                self._free.add(cpu)
+                self._cond.notify()
+
+    @staticmethod
+    def from_config(config: Optional[dict]) -> Optional['CpuAllocator']:
+        if config is None or not config.get('enabled', False):
+            return None
+        if 'cpus' in config:
+            cpus = parse_cpu_list(str(config['cpus']))
+        else:
+            cpus = sorted(sched_getaffinity(0))
+        if len(cpus) == 0:
+            raise Exception('No cpu available for sandboxes')
+        return CpuAllocator(cpus, config.get('reserve_smt_siblings', True))
@@ -0,0 +1,45 @@
+__all__ = ('disk_usage',)
+
+from math import ceil
+from os import lstat, scandir
+from pathlib import PosixPath
+from stat import S_ISDIR
+from typing import List, Optional, Set, Tuple
+
+
+def disk_usage(path: PosixPath) -> Optional[Tuple[int, int]]:
+    '''
+    Computes what the patched `du -s` reports for path: the disk usage in
+    KiB (directories included, hardlinked files counted once) and the
+    number of files other than directories.
+
+    Returns None if some directory cannot be read by us, e.g. one created
+    with mode 0700 by the sandboxed program, or the tree changes while it
+    is walked; the caller should then fall back to running du inside a
+    sandbox.
+    '''
+    seen: Set[Tuple[int, int]] = set()
+    blocks = 0
+    files = 0
+    # directories are walked with an explicit stack, as the program may
+    # nest them deeper than the recursion limit.
+    dirs: List[str] = [str(path)]
+    try:
+        blocks += lstat(path).st_blocks
+        while len(dirs) > 0:
+            with scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_nlink > 1:
+                        if (st.st_dev, st.st_ino) in seen:
+                            continue
+                        seen.add((st.st_dev, st.st_ino))
+                    blocks += st.st_blocks
+                    if S_ISDIR(st.st_mode):
+                        dirs.append(entry.path)
+                    else:
+                        files += 1
+    except OSError:
+        return None
+    # st_blocks is in units of 512 bytes.
+    return ceil(blocks * 512 / 1024), files
@@ -0,0 +1,98 @@
+__all__ = 'SandboxDir', 'SandboxPool'
+
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import PosixPath
+from shutil import rmtree
+from typing import Iterator, List, Optional
+
+from commons.util import TempDir
+from judger2.config import cache_dir, working_dir
+from judger2.util import PhaseTimer
+
+logger = getLogger(__name__)
+
+
+class SandboxDir:
+    '''
+    The private directory of a sandbox run: the (empty) dir nsjail
+    chroots to, the dir runner.c writes its result into, and the file
+    stderr of the sandbox goes to.
+    '''
+
+    def __init__(self):
+        self._temp_dir = TempDir()
+        self.path = self._temp_dir.__enter__()
+        self.path.chmod(0o700)
+        self.chroot = self.path / 'root'
+        self.chroot.mkdir(0o750)
+        self.result_dir = self.path / 'result'
+        self.result_dir.mkdir(0o700)
+        self.result_file = self.result_dir / 'result'
+        self.stderr = self.path / 'stderr'
+
+    def reset(self) -> bool:
+        '''
+        Prepares the dir for another run. nsjail leaves mount points of
+        the bind mounts behind in the chroot dir; those of per-run paths
+        (working dirs and cached files) are removed, while those of system
+        paths are the same for every run and are kept. Returns whether the
+        dir is clean enough to be reused.
+        '''
+        self.result_file.unlink(missing_ok=True)
+        clean = True
+        for prefix in (working_dir, cache_dir):
+            stub = self.chroot / PosixPath(prefix).relative_to('/')
+            rmtree(stub, ignore_errors=True)
+            clean = clean and not stub.exists()
+        return clean
+
+    def destroy(self):
+        self._temp_dir.__exit__(None, None, None)
+
+
+class SandboxPool:
+    '''
+    Keeps prepared sandbox dirs around, so that a sandbox run does not
+    need to create a temp dir, nor chown and remove it afterwards.
+    '''
+
+    def __init__(self, size: int):
+        self.size = size
+        self._free: List[SandboxDir] = []
+
+    def prewarm(self):
+        while len(self._free) < self.size:
+            self._free.append(SandboxDir())
+
+    def acquire(self) -> SandboxDir:
+        if len(self._free) > 0:
+            return self._free.pop()
+        return SandboxDir()
+
+    def release(self, sandbox: SandboxDir):
+        try:
+            reusable = sandbox.reset()
+        except Exception as e:
+            logger.warning(f'cannot reset sandbox dir {sandbox.path}: {e}')
+            reusable = False
+        if reusable and len(self._free) < self.size:
+            self._free.append(sandbox)
+        else:
+            sandbox.destroy()
+
+    @contextmanager
+    def use(self, pooled: bool = True,
+            phases: Optional[PhaseTimer] = None) -> Iterator[SandboxDir]:
+        if phases is None:
+            phases = PhaseTimer()
+        with phases.phase('setup'):
+            sandbox = self.acquire() if pooled else SandboxDir()
+        try:
+            yield sandbox
+        finally:
+            with phases.phase('teardown'):
+                if pooled:
+                    self.release(sandbox)
+                else:
+                    sandbox.destroy()
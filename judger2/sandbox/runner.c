@@ -11,10 +11,14 @@
 
 #include <errno.h>
 #include <fcntl.h>
+#include <linux/perf_event.h>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #include <sys/resource.h>
 #include <sys/stat.h>
+#include <sys/syscall.h>
 #include <sys/time.h>
 #include <sys/wait.h>
 #include <time.h>
@@ -61,6 +65,29 @@ void set_timer (time_ms_t time) {
   check(setitimer(ITIMER_REAL, &val, NULL), "setitimer");
 }
 
+time_ms_t timeval_to_ms (struct timeval tv) {
+  return tv.tv_sec * SEC_TO_MS + tv.tv_usec / MS_TO_US;
+}
+
+/* Counts user space instructions retired by the child and its
+   descendants, starting from execve(2). Returns -1 if hardware
+   counters are not available (e.g. in a VM, or forbidden by
+   perf_event_paranoid).
+ */
+int open_instruction_counter (pid_t pid) {
+  struct perf_event_attr attr;
+  memset(&attr, 0, sizeof(attr));
+  attr.type = PERF_TYPE_HARDWARE;
+  attr.size = sizeof(attr);
+  attr.config = PERF_COUNT_HW_INSTRUCTIONS;
+  attr.disabled = 1;
+  attr.enable_on_exec = 1;
+  attr.inherit = 1;
+  attr.exclude_kernel = 1;
+  attr.exclude_hv = 1;
+  return syscall(SYS_perf_event_open, &attr, pid, -1, -1, 0);
+}
+
 /* send error information to parent */
 inline static void die_child (int fd, const char *msg) {
   perror(msg);
@@ -92,6 +119,10 @@ int main (int argc, char **argv) {
 
   int pipefd[2];
   check(pipe2(pipefd, O_NONBLOCK | O_CLOEXEC), "pipe");
+  /* The child waits on this pipe until the instruction counter
+     is attached to it. */
+  int gofd[2];
+  check(pipe2(gofd, O_CLOEXEC), "pipe");
 
   pid_t child_pid = fork();
   check(child_pid < 0, "fork");
@@ -99,6 +130,12 @@ int main (int argc, char **argv) {
     if (fclose(results)) {
       die_child(pipefd[1], "fclose");
     }
+    char go;
+    if (close(gofd[1]) || read(gofd[0], &go, 1) != 1) {
+      die_child(pipefd[1], "read");
+    }
+    /* Attaching the counter needs the same uid, so setuid only
+       after that. */
     if (setuid(WORKER_UID)) {
       die_child(pipefd[1], "setuid");
     }
@@ -109,7 +146,12 @@ int main (int argc, char **argv) {
     die_child(pipefd[1], "execv");
   }
 
+  check(close(gofd[0]), "close");
+  int perf_fd = open_instruction_counter(child_pid);
   time_ms_t start_time = gettime();
+  check(write(gofd[1], "", 1) != 1, "write");
+  check(close(gofd[1]), "close");
+
   int status = -1;
   struct rusage rusage;
   /* Using wait4(2) here to get rusage data directly. */
@@ -119,6 +161,16 @@ int main (int argc, char **argv) {
 
   /* maxrss is in kbytes on Linux. */
   long mem = rusage.ru_maxrss * 1024;
+  time_ms_t cpu_time = timeval_to_ms(rusage.ru_utime)
+                     + timeval_to_ms(rusage.ru_stime);
+  long long instructions = -1;
+  if (perf_fd >= 0) {
+    uint64_t count;
+    if (read(perf_fd, &count, sizeof(count)) == sizeof(count)) {
+      instructions = count;
+    }
+    close(perf_fd);
+  }
 
   int code;
   if (WIFEXITED(status)) {
@@ -136,7 +188,8 @@ int main (int argc, char **argv) {
     }
   }
 
-  fprintf(results, "run %d %lld %ld\n", code, real_time, mem);
+  fprintf(results, "run %d %lld %ld %lld %lld\n",
+          code, real_time, mem, cpu_time, instructions);
   check(fclose(results), "fclose");
 
   return 0;
@@ -2,18 +2,23 @@ from logging import getLogger
 from math import isinf, isnan
 from os import devnull
 from pathlib import PosixPath
-from shutil import copy2
+from random import random
 from typing import Any, Callable, Coroutine, Dict, Literal, Optional, Type
 from typing_extensions import TypeAlias
 
 from commons.task_typing import (Checker, CheckInput, CheckResult,
                                  CompareChecker, DirectChecker, RunResult, SpjChecker)
 
+from commons.util import NormalizedDigest, asyncrun
 from judger2.cache import ensure_cached
-from judger2.config import checker_cmp_limits, diff
+from judger2.compare import compare_files
+from judger2.config import checker_ab_sample_rate, checker_cmp_limits
+from judger2.metrics import timed
 from judger2.sandbox import run_with_limits
 from judger2.steps.compile_ import NotCompiledException, ensure_input
-from judger2.util import TempDir, copy_supplementary_files
+from judger2.steps.spj_batch import checker_spj_batch
+from judger2.util import (TempDir, copy_supplementary_files, elf_mode,
+                          stage_file)
 
 logger = getLogger(__name__)
 
@@ -34,10 +39,11 @@ async def check(outfile: CheckInput, cwd: PosixPath, checker: Checker) -> CheckR
         return CheckResult('bad_problem', 'Nothing to check')
 
     # check
-    return await checkers[checker.__class__](inf, ouf, cwd, checker)
+    with timed('check'):
+        return await checkers[checker.__class__](inf, ouf, cwd, checker)
 
 
-diff_errexit_code = 1
+checker_errexit_code = 1
 checker_exe = PosixPath(__file__).parent.parent / 'checker' / 'checker'
 if not checker_exe.exists():
     raise Exception('checker executable not found')
@@ -46,7 +52,8 @@ checker_exe = str(checker_exe)
 async def checker_cmp_abtest(infile, outfile, cwd, checker):
     resA = await checker_cmp(infile, outfile, cwd, checker)
     if not checker.ignore_whitespace or \
-        resA.result not in ['accepted', 'wrong_answer']:
+        resA.result not in ['accepted', 'wrong_answer'] or \
+        random() >= checker_ab_sample_rate:
         return resA
     resB = await checker_cmp_b(infile, outfile, cwd, checker)
     if resA.result != resB.result:
@@ -69,36 +76,42 @@ async def checker_cmp_b(_infile, outfile: PosixPath, _cwd, checker: CompareCheck
             checker_cmp_limits,
             supplementary_paths=supplementary_paths,
         )
-    if res.error == 'runtime_error' and res.code == diff_errexit_code:
+    if res.error == 'runtime_error' and res.code == checker_errexit_code:
         return CheckResult('wrong_answer', '')
     if res.error is not None:
         logger.error(f'checker failed with {res.error}: {res.message}')
         return CheckResult('system_error', f'checker B failed with {res.error}: {res.message}')
     return CheckResult('accepted', '', 1.0)
 
+def output_digest(outfile: PosixPath) -> NormalizedDigest:
+    with open(outfile, 'rb') as f:
+        return NormalizedDigest.of_file(f)
+
 async def checker_cmp(_infile, outfile: PosixPath, _cwd, checker: CompareChecker):
+    if checker.ignore_whitespace and checker.answer_digest is not None:
+        digest = await asyncrun(lambda: output_digest(outfile))
+        if digest.size == checker.answer_size \
+        and digest.hexdigest() == checker.answer_digest:
+            logger.debug('output matches answer digest')
+            return CheckResult('accepted', '', 1.0)
     ans = (await ensure_cached(checker.answer)).path
-    flags = '-qZB' if checker.ignore_whitespace else '-q'
-    argv = [str(diff), flags, str(outfile), str(ans)]
-    logger.debug(f'about to run {argv}')
-    with TempDir() as cwd:
-        res = await run_with_limits(
-            argv,
-            cwd,
-            checker_cmp_limits,
-            supplementary_paths=['/bin', '/usr/bin', str(outfile), str(ans)],
-        )
-    if res.error == 'runtime_error' and res.code == diff_errexit_code:
+    logger.debug(f'comparing {outfile} with {ans}')
+    try:
+        same = await asyncrun(lambda: compare_files(outfile, ans, checker.ignore_whitespace))
+    except OSError as e:
+        logger.error(f'cannot compare output: {e}')
+        return CheckResult('system_error', f'checker failed: {e}')
+    if not same:
         return CheckResult('wrong_answer', '')
-    if res.error is not None:
-        logger.error(f'diff failed with {res.error}: {res.message}')
-        return CheckResult('system_error', f'checker failed with {res.error}: {res.message}')
     return CheckResult('accepted', '', 1.0)
 
 
 def checker_read_float(outfile: PosixPath, message: str = ''):
+    return checker_parse_score(outfile.read_text(errors='replace'), message)
+
+def checker_parse_score(text: str, message: str = ''):
     try:
-        score = float(outfile.read_text(errors='replace'))
+        score = float(text)
     except ValueError:
         return CheckResult('bad_problem', 'Invalid SPJ checker: score not number')
     if isinf(score):
@@ -118,6 +131,10 @@ async def checker_spj(infile: Optional[PosixPath], outfile: PosixPath, \
     # get spj binary
     if checker.format == 'scorer':
         raise NotImplementedError()
+    if checker.format == 'batch':
+        batch_res = await checker_spj_batch(infile, outfile, user_cwd, checker)
+        if batch_res is not None:
+            return batch_res
     try:
         exe = (await ensure_input(checker.executable)).path
     except NotCompiledException as e:
@@ -126,8 +143,7 @@ async def checker_spj(infile: Optional[PosixPath], outfile: PosixPath, \
     # run spj
     with TempDir() as cwd:
         exec_file = cwd / 'spj'
-        copy2(exe, exec_file)
-        exec_file.chmod(0o550)
+        await stage_file(exe, exec_file, elf_mode)
 
         await copy_supplementary_files(checker.supplementary_files, cwd)
 
@@ -1,28 +1,42 @@
 __all__ = 'compile', 'ensure_input'
 
-from dataclasses import dataclass
+import json
+from asyncio import Lock, Task, create_task, gather, shield
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+from hashlib import sha256
 from logging import getLogger
 from os import chmod, utime
 from pathlib import PosixPath
-from shutil import copy2, which
+from re import MULTILINE
+from re import compile as re_compile
+from shutil import rmtree, which
 from subprocess import DEVNULL
 from tempfile import NamedTemporaryFile
-from typing import Any, Callable, Coroutine, Dict, List, Type
-from uuid import uuid4
+from typing import (Any, AsyncIterator, Callable, Coroutine, Dict, List,
+                    Optional, Set, Tuple, Type)
 
 from typing_extensions import TypeAlias
 
 from commons.task_typing import (CompileLocalResult, CompileResult,
                                  CompileSource, CompileSourceCpp,
                                  CompileSourceGit, CompileSourceVerilog,
-                                 CompileTask, Input, ResourceUsage)
-from judger2.cache import CachedFile, ensure_cached, upload
-from judger2.config import (cache_dir, cxx, cxx_exec_name, cxx_file_name,
+                                 CompileTask, Input, ResourceUsage,
+                                 RunResult)
+from commons.util import asyncrun, format_exc
+from judger2.cache import (CachedFile, add_compiled, ensure_cached,
+                           git_mirrors_dir, lookup_compiled, objects_dir,
+                           pin_scope, store, upload_object, use_object)
+from judger2.config import (compile_cache, cxx, cxx_exec_name, cxx_file_name,
                             cxxflags, exec_file_name, git_exec_name,
-                            git_ssh_private_key, gitflags, verilog,
-                            verilog_exec_name, verilog_file_name)
+                            git_mirror, git_ssh_private_key, gitflags,
+                            verilog, verilog_exec_name, verilog_file_name)
+from judger2.metrics import timed
+from judger2.pch import std_pch_args
 from judger2.sandbox import chown_back, chown_to_user, run_with_limits
-from judger2.util import TempDir, copy_supplementary_files, FileConflictException
+from judger2.util import (FileConflictException, TempDir,
+                          copy_supplementary_files, elf_mode, stage_file,
+                          toolchain_version)
 
 logger = getLogger(__name__)
 
@@ -31,7 +45,61 @@ class StageResult:
     success: bool
     message: str
 
+def toolchain_of(source: CompileSource) -> Optional[List[str]]:
+    if isinstance(source, CompileSourceCpp):
+        assert cxx is not None
+        return [cxx, toolchain_version(cxx, '--version')] + cxxflags
+    if isinstance(source, CompileSourceVerilog):
+        assert verilog is not None
+        return [verilog, toolchain_version(verilog, '-V')]
+    # a git repo may change without its url changing.
+    return None
+
+def cache_key(kind: str, toolchain: List[str], files: List[CachedFile],
+              limits: ResourceUsage) -> str:
+    ingredients = {
+        'type': kind,
+        'toolchain': toolchain,
+        # cached objects are named after their content.
+        'files': [[x.filename, x.path.name] for x in files],
+        'limits': asdict(limits),
+    }
+    text = json.dumps(ingredients, sort_keys=True)
+    return f'compile-{sha256(text.encode()).hexdigest()}'
+
+async def compile_cache_key(task: CompileTask) -> Optional[str]:
+    '''
+    Returns the key of the compile cache for task, which covers everything
+    the compiler output depends on; None if the task should not be cached.
+    '''
+    if not compile_cache:
+        return None
+    source = task.source
+    toolchain = toolchain_of(source)
+    if toolchain is None:
+        return None
+    assert not isinstance(source, CompileSourceGit)
+    files = await gather(ensure_cached(source.main),
+                         *map(ensure_cached, task.supplementary_files))
+    return cache_key(source.__class__.__name__, toolchain, list(files),
+                     task.limits)
+
+async def publish_artifact(task: CompileTask, object_id: str, message: str) \
+    -> CompileLocalResult:
+    if task.artifact is not None:
+        local_path = (await upload_object(object_id, task.artifact.url)).path
+    else:
+        local_path = objects_dir / object_id
+    return CompileLocalResult(CompileResult('compiled', message), local_path)
+
 async def compile(task: CompileTask) -> CompileLocalResult:
+    key = await compile_cache_key(task)
+    if key is not None:
+        entry = lookup_compiled(key)
+        if entry is not None:
+            logger.debug(f'compile cache hit: {key}')
+            return await publish_artifact(task, entry.object, entry.message)
+
     with TempDir() as cwd:
         type = task.source.__class__
         # prepare
@@ -53,6 +121,21 @@ async def compile(task: CompileTask) -> CompileLocalResult:
                 local_path=None,
             )
 
+        if isinstance(task.source, CompileSourceCpp):
+            try:
+                await prepare_pch(cwd, task)
+            except Exception as e:
+                logger.warning(f'cannot prepare precompiled header: {format_exc(e)}')
+        elif isinstance(task.source, CompileSourceGit):
+            # a git repo is identified only once it is cloned.
+            key = await git_cache_key(cwd, task)
+            if key is not None:
+                entry = lookup_compiled(key)
+                if entry is not None:
+                    logger.debug(f'compile cache hit: {key}')
+                    return await publish_artifact(task, entry.object,
+                                                  entry.message)
+
         # compile
         # The compiled program returned by these functions
         # reside inside cwd. As cwd is deleted once this
@@ -78,24 +161,20 @@ async def compile(task: CompileTask) -> CompileLocalResult:
         # set by the compiler or by a bad mask.
         chown_back(cwd)
 
-        # upload artifacts
-        if task.artifact is not None:
-            local_path = (await upload(res.local_path, task.artifact.url)).path
-        else:
-            local_path = PosixPath(cache_dir) / str(uuid4())
-            copy2(res.local_path, local_path)
-            # touch the local file so the file will be eventually deleted
-            utime(local_path)
-
-        # done
-        return CompileLocalResult(result=res.result, local_path=local_path)
+        # cache and upload artifacts; with the mode executables are
+        # staged with, so that running them takes a hardlink.
+        object_id = store(res.local_path, elf_mode)
+        if key is not None:
+            add_compiled(key, object_id, res.result.message)
+        return await publish_artifact(task, object_id, res.result.message)
 
 
 class NotCompiledException(Exception): pass
 
 async def ensure_input(input: Input) -> CachedFile:
     if isinstance(input, CompileTask):
-        res = await compile(input)
+        with timed('compile'):
+            res = await compile(input)
         if res.result.result != 'compiled':
             raise NotCompiledException(res.result.message)
         assert res.local_path is not None
@@ -111,7 +190,7 @@ async def prepare_cpp(
 ) -> StageResult:
     main_file = (await ensure_cached(source.main)).path
     code_file = cwd / cxx_file_name
-    copy2(main_file, code_file)
+    await stage_file(main_file, code_file)
     return StageResult(True, '')
 
 async def compile_cpp(
@@ -122,16 +201,92 @@ async def compile_cpp(
     code_file = cwd / cxx_file_name
     exec_file = cwd / cxx_exec_name
     assert cxx is not None
+    pch_flags, pch_paths = std_pch_args()
     res = await run_with_limits(
-        [cxx] + cxxflags + [str(code_file), '-o', str(exec_file)],
+        [cxx] + cxxflags + pch_flags + [str(code_file), '-o', str(exec_file)],
         cwd, limits,
-        supplementary_paths=['/bin', '/usr/bin', '/usr/include'],
+        supplementary_paths=['/bin', '/usr/bin', '/usr/include'] + pch_paths,
     )
     if res.error is not None:
         return CompileLocalResult.from_run_failure(res)
     return CompileLocalResult.from_file(exec_file, res.message)
 
 
+include_pattern = re_compile(r'^\s*#\s*include\s*([<"])([^>"]*)[>"]', MULTILINE)
+
+def first_include(path: PosixPath) -> Optional[str]:
+    '''
+    Returns the header of the first #include in path if it is a local
+    (#include "...") one, as only then can g++ use a precompiled header.
+    '''
+    match = include_pattern.search(path.read_text(errors='replace'))
+    if match is None or match.group(1) != '"':
+        return None
+    return match.group(2)
+
+# precompiled headers being built, and those failed to build, by cache key.
+pch_builds: Dict[str, 'Task[Optional[str]]'] = {}
+pch_failed: Set[str] = set()
+pch_failed_max = 4096
+
+async def prepare_pch(cwd: PosixPath, task: CompileTask):
+    '''
+    Puts a precompiled task.precompile_header next to the header in cwd,
+    building it first unless an earlier task did. g++ uses it in place of
+    the header if it can, and silently ignores it otherwise.
+    '''
+    header = task.precompile_header
+    if header is None or not compile_cache \
+    or first_include(cwd / cxx_file_name) != header:
+        return
+    toolchain = toolchain_of(task.source)
+    assert toolchain is not None
+    files = await gather(*map(ensure_cached, task.supplementary_files))
+    key = cache_key(f'pch:{header}', toolchain, list(files), task.limits)
+    if key in pch_failed:
+        return
+    entry = lookup_compiled(key, count=False)
+    object_id: str
+    if entry is not None:
+        object_id = entry.object
+    else:
+        if key not in pch_builds:
+            build = create_task(build_pch(key, task, header))
+            pch_builds[key] = build
+            build.add_done_callback(lambda _: pch_builds.pop(key, None))
+        built = await shield(pch_builds[key])
+        if built is None:
+            # failed to build; compile without it.
+            return
+        object_id = built
+        use_object(object_id)
+    logger.debug(f'using precompiled {header}: {key}')
+    await stage_file(objects_dir / object_id, cwd / f'{header}.gch')
+
+async def build_pch(key: str, task: CompileTask, header: str) -> Optional[str]:
+    # shared by tasks, so it must not pin into the scope of the first one.
+    with pin_scope(), TempDir() as cwd:
+        await copy_supplementary_files(task.supplementary_files, cwd)
+        pch = cwd / f'{header}.gch'
+        assert cxx is not None
+        res = await run_with_limits(
+            [cxx] + cxxflags + ['-x', 'c++-header', str(cwd / header),
+                                '-o', str(pch)],
+            cwd, task.limits,
+            supplementary_paths=['/bin', '/usr/bin', '/usr/include'],
+        )
+        if res.error is not None or not pch.is_file():
+            logger.debug(f'cannot precompile {header}: {res.message}')
+            if len(pch_failed) >= pch_failed_max:
+                pch_failed.clear()
+            pch_failed.add(key)
+            return None
+        chown_back(cwd)
+        object_id = store(pch)
+        add_compiled(key, object_id, '')
+        return object_id
+
+
 def get_resolv_conf_path():
     resolv_conf = PosixPath('/etc/resolv.conf')
     if not resolv_conf.exists():
@@ -142,6 +297,155 @@ def get_resolv_conf_path():
 
 resolv_conf_path = get_resolv_conf_path()
 git_ssh_config_path = str(PosixPath(__file__).with_name('ssh_config'))
+git_env = [
+    'GIT_CONFIG_COUNT=2',
+    'GIT_CONFIG_KEY_0=safe.directory',
+    'GIT_CONFIG_VALUE_0=*',
+    'GIT_CONFIG_KEY_1=url.git@github.com:.insteadOf',
+    'GIT_CONFIG_VALUE_1=https://github.com/'
+]
+
+async def run_git_step(
+    argv: List[str],
+    cwd: PosixPath,
+    limits: ResourceUsage,
+    *,
+    output = DEVNULL,
+    supplementary_paths: List[str] = [],
+) -> RunResult:
+    '''Runs a git command with network access and the ssh key of the OJ.'''
+    tempfile = NamedTemporaryFile('w+')
+    try:
+        chmod(tempfile.name, 0o600)
+        tempfile.write(git_ssh_private_key)
+        tempfile.flush()
+        chown_to_user(tempfile.name)
+        bind = [
+            '/bin', '/usr/bin', '/usr/include', '/usr/share', '/etc',
+            f'{git_ssh_config_path}:/etc/ssh/ssh_config',
+            f'{tempfile.name}:/id_acmoj',
+        ] + supplementary_paths
+        if resolv_conf_path is not None:
+            bind.append(resolv_conf_path)
+        return await run_with_limits(
+            argv, cwd, limits,
+            outfile=output,
+            supplementary_paths=bind,
+            network_access=True,
+            env=git_env,
+        )
+    finally:
+        chown_back(tempfile.name)
+        tempfile.close()
+
+# held while a mirror is updated and cloned from, by mirror name, with
+# the number of clones holding or waiting for each.
+git_mirror_locks: Dict[str, Lock] = {}
+git_mirror_lock_users: Dict[str, int] = {}
+
+@asynccontextmanager
+async def git_mirror_lock(name: str) -> AsyncIterator[None]:
+    lock = git_mirror_locks.setdefault(name, Lock())
+    git_mirror_lock_users[name] = git_mirror_lock_users.get(name, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        git_mirror_lock_users[name] -= 1
+        if git_mirror_lock_users[name] == 0:
+            del git_mirror_lock_users[name]
+            del git_mirror_locks[name]
+
+def git_mirror_path(url: str) -> PosixPath:
+    return git_mirrors_dir / sha256(url.encode()).hexdigest()
+
+git_symref_regex = re_compile(r'^ref: (refs/heads/[^\s:?*\[\\]+)\tHEAD$',
+                              MULTILINE)
+
+async def git_remote_head(mirror: PosixPath, limits: ResourceUsage) \
+    -> Optional[str]:
+    '''Returns the branch HEAD of the remote of mirror points at.'''
+    git = which('git')
+    assert git is not None
+    with TempDir() as d, open(d / 'remote-head', 'w+b') as ouf:
+        res = await run_git_step([git, 'ls-remote', '--symref', 'origin',
+                                  'HEAD'], mirror, limits, output=ouf)
+        ouf.seek(0)
+        text = ouf.read(4096).decode(errors='replace')
+    if res.error is not None:
+        logger.info(f'cannot get remote HEAD of {mirror}: {res.message}')
+        return None
+    match = git_symref_regex.search(text)
+    if match is None or '..' in match[1]:
+        return None
+    return match[1]
+
+async def update_git_mirror(url: str, limits: ResourceUsage) \
+    -> Optional[PosixPath]:
+    '''
+    Creates or fetches into the bare mirror of url. Returns None if that
+    fails, as the repo may be gone or no longer accessible to us; a stale
+    mirror must not be used then.
+    '''
+    git = which('git')
+    assert git is not None
+    mirror = git_mirror_path(url)
+    created = not mirror.is_dir()
+    if created:
+        mirror.mkdir(parents=True)
+        mirror.chmod(0o770)
+        argv = [git, 'clone', '--mirror', url, '.']
+    else:
+        argv = [git, 'fetch', '--prune', 'origin']
+    head = None
+    await asyncrun(lambda: chown_to_user(mirror))
+    try:
+        res = await run_git_step(argv, mirror, limits)
+        # fetch leaves HEAD alone, while the default branch of the repo
+        # may have changed (or been renamed) since the mirror was cloned.
+        if res.error is None and not created:
+            head = await git_remote_head(mirror, limits)
+    finally:
+        await asyncrun(lambda: chown_back(mirror))
+    if res.error is not None:
+        logger.info(f'cannot update git mirror of {repr(url)}: {res.message}')
+        if created:
+            rmtree(mirror, ignore_errors=True)
+        return None
+    if head is not None:
+        (mirror / 'HEAD').write_text(f'ref: {head}\n')
+    utime(mirror)
+    return mirror
+
+async def clone_from_mirror(
+    cwd: PosixPath,
+    source: CompileSourceGit,
+    limits: ResourceUsage,
+) -> Optional[RunResult]:
+    '''
+    Clones source into cwd through its local mirror. Returns None if the
+    mirror is not available, in which case the repo should be cloned
+    directly.
+    '''
+    git = which('git')
+    assert git is not None
+    async with git_mirror_lock(git_mirror_path(source.url).name):
+        mirror = await update_git_mirror(source.url, limits)
+        if mirror is None:
+            return None
+        res = await run_git_step(
+            [git, 'clone', '--depth', '1', f'file://{mirror}', '.'],
+            cwd, limits, supplementary_paths=[str(mirror)])
+    if res.error is not None:
+        return res
+    # relative urls of submodules are resolved against origin.
+    res = await run_git_step(
+        [git, 'remote', 'set-url', 'origin', source.url], cwd, limits)
+    if res.error is not None or not (cwd / '.gitmodules').is_file():
+        return res
+    return await run_git_step(
+        [git, 'submodule', 'update', '--init', '--recursive', '--depth', '1'],
+        cwd, limits)
 
 async def prepare_git(
     cwd: PosixPath,
@@ -150,84 +454,81 @@ async def prepare_git(
 ) -> StageResult:
     logger.debug(f'about to compile git repo {repr(source.url)}')
 
-    async def run_build_step(argv: List[str], *, output = DEVNULL):
-        tempfile = NamedTemporaryFile('w+')
-        try:
-            chmod(tempfile.name, 0o600)
-            tempfile.write(git_ssh_private_key)
-            tempfile.flush()
-            chown_to_user(tempfile.name)
-            bind = [
-                '/bin', '/usr/bin', '/usr/include', '/usr/share', '/etc',
-                f'{git_ssh_config_path}:/etc/ssh/ssh_config',
-                f'{tempfile.name}:/id_acmoj',
-            ]
-            if resolv_conf_path is not None:
-                bind.append(resolv_conf_path)
-            return await run_with_limits(
-                argv, cwd, limits,
-                outfile=output,
-                supplementary_paths=bind,
-                network_access=True,
-                env=[
-                    'GIT_CONFIG_COUNT=2',
-                    'GIT_CONFIG_KEY_0=safe.directory',
-                    'GIT_CONFIG_VALUE_0=*',
-                    'GIT_CONFIG_KEY_1=url.git@github.com:.insteadOf',
-                    'GIT_CONFIG_VALUE_1=https://github.com/'
-                ],
-            )
-        finally:
-            chown_back(tempfile.name)
-            tempfile.close()
-    
-    # clone
-    git = which('git')
-    assert git is not None
-    git_argv = [git, 'clone', source.url, '.'] + gitflags
-    logger.debug(f'about to run {git_argv}')
-    clone_res = await run_build_step(git_argv)
+    clone_res = None
+    if git_mirror:
+        clone_res = await clone_from_mirror(cwd, source, limits)
+    if clone_res is None:
+        git = which('git')
+        assert git is not None
+        git_argv = [git, 'clone', source.url, '.'] + gitflags
+        logger.debug(f'about to run {git_argv}')
+        clone_res = await run_git_step(git_argv, cwd, limits)
     if clone_res.error is not None:
         return StageResult(False, clone_res.message)
     else:
         return StageResult(True, '')
 
-async def compile_git(
+async def run_git_build_step(
+    argv: List[str],
     cwd: PosixPath,
-    source: CompileSourceGit,
     limits: ResourceUsage,
-) -> CompileLocalResult:
-    async def run_build_step(argv: List[str], *, output = DEVNULL):
-        bind = ['/bin', '/usr/bin', '/usr/include', '/usr/share', '/etc']
-        if resolv_conf_path is not None:
-            bind.append(resolv_conf_path)
-        return await run_with_limits(
-            argv, cwd, limits,
-            outfile=output,
-            supplementary_paths=bind,
-            network_access=False,
-            env=[
-                'GIT_CONFIG_COUNT=2',
-                'GIT_CONFIG_KEY_0=safe.directory',
-                'GIT_CONFIG_VALUE_0=*',
-                'GIT_CONFIG_KEY_1=url.git@github.com:.insteadOf',
-                'GIT_CONFIG_VALUE_1=https://github.com/'
-            ],
-        )
+    *,
+    output = DEVNULL,
+) -> RunResult:
+    bind = ['/bin', '/usr/bin', '/usr/include', '/usr/share', '/etc']
+    if resolv_conf_path is not None:
+        bind.append(resolv_conf_path)
+    return await run_with_limits(
+        argv, cwd, limits,
+        outfile=output,
+        supplementary_paths=bind,
+        network_access=False,
+        env=git_env,
+    )
 
+async def git_commit_hash(cwd: PosixPath, limits: ResourceUsage) \
+    -> Tuple[RunResult, str]:
     git = which('git')
     assert git is not None
-
-    # get commit hash
     with TempDir() as d, open(d / 'commit-hash', 'w+b') as ouf:
         commit_hash_argv = [git, 'log', '-1', '--pretty=%H']
-        commit_hash_res = await run_build_step(commit_hash_argv, output=ouf)
-        if commit_hash_res.error is not None:
-            return CompileLocalResult.from_run_failure(commit_hash_res)
+        res = await run_git_build_step(commit_hash_argv, cwd, limits,
+                                       output=ouf)
         ouf.seek(0)
-        commit_hash = ouf.read(128).decode().strip()
-        logger.debug(f'git commit hash: {commit_hash}')
-        message = f'Using git commit {commit_hash}'
+        return res, ouf.read(128).decode().strip()
+
+async def git_cache_key(cwd: PosixPath, task: CompileTask) -> Optional[str]:
+    '''
+    Returns the key of the compile cache for a cloned git repo, which is
+    identified by its commit (submodules are pinned by the commit as well).
+    '''
+    if not compile_cache:
+        return None
+    res, commit_hash = await git_commit_hash(cwd, task.limits)
+    if res.error is not None or commit_hash == '':
+        return None
+    toolchain = [commit_hash]
+    for tool in (cxx, which('cmake'), which('make')):
+        if tool is not None:
+            toolchain += [tool, toolchain_version(tool, '--version')]
+    files = await gather(*map(ensure_cached, task.supplementary_files))
+    return cache_key(CompileSourceGit.__name__, toolchain, list(files),
+                     task.limits)
+
+async def compile_git(
+    cwd: PosixPath,
+    source: CompileSourceGit,
+    limits: ResourceUsage,
+) -> CompileLocalResult:
+    async def run_build_step(argv: List[str], *, output = DEVNULL):
+        return await run_git_build_step(argv, cwd, limits, output=output)
+
+    # get commit hash
+    commit_hash_res, commit_hash = await git_commit_hash(cwd, limits)
+    if commit_hash_res.error is not None:
+        return CompileLocalResult.from_run_failure(commit_hash_res)
+    logger.debug(f'git commit hash: {commit_hash}')
+    message = f'Using git commit {commit_hash}'
 
     # configure
     cmake_lists_path = cwd / 'CMakeLists.txt'
@@ -276,7 +577,7 @@ async def prepare_verilog(
 ) -> StageResult:
     main_file = (await ensure_cached(source.main)).path
     code_file = cwd / verilog_file_name
-    copy2(main_file, code_file)
+    await stage_file(main_file, code_file)
     return StageResult(True, '')
 
 async def compile_verilog(
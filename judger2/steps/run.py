@@ -2,18 +2,17 @@ __all__ = ('run',)
 
 from asyncio.subprocess import DEVNULL
 from dataclasses import dataclass
-from os import chmod
 from pathlib import PosixPath
-from shutil import copy2
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from commons.task_typing import Input, RunArgs, RunResult
 from judger2.cache import ensure_cached, upload
 from judger2.config import (python, valgrind, valgrind_args,
                             valgrind_errexit_code, verilog_interpreter)
+from judger2.metrics import observe, timed
 from judger2.sandbox import run_with_limits
 from judger2.steps.compile_ import NotCompiledException, ensure_input
-from judger2.util import copy_supplementary_files
+from judger2.util import copy_supplementary_files, elf_mode, stage_file
 
 
 @dataclass
@@ -24,16 +23,16 @@ class RunParams:
     tmpfsmount: bool = False
 
 class BaseRunner:
+    # mode the program is staged with, if it is to be executed directly.
+    mode: Optional[int] = None
     def prepare(self, program: PosixPath) -> RunParams:
         raise NotImplementedError()
     def interpret_result(self, result: RunResult) -> RunResult:
         return result
 
-elf_mode = 0o550
-
 class ElfRunner(BaseRunner):
+    mode = elf_mode
     def prepare(self, program: PosixPath):
-        chmod(program, elf_mode)
         return RunParams([str(program)], [])
 
 class PythonRunner(BaseRunner):
@@ -42,8 +41,8 @@ class PythonRunner(BaseRunner):
         return RunParams(argv, ['/bin', '/usr/bin', '/usr/libexec'])
 
 class ValgrindRunner(BaseRunner):
+    mode = elf_mode
     def prepare(self, program: PosixPath):
-        chmod(program, elf_mode)
         assert valgrind is not None
         argv = [valgrind] + valgrind_args + [str(program)]
         return RunParams(argv, ['/bin', '/usr/bin', '/usr/libexec'], False, True)
@@ -84,21 +83,21 @@ async def run(oufdir: PosixPath, cwd: PosixPath, input: Input, args: RunArgs) \
         exe = await ensure_input(input)
     except NotCompiledException as e:
         return RunResult('compile_error', str(e))
+    runner = runners[args.type]
     exec_file = oufdir / exe.filename
-    copy2(exe.path, exec_file)
+    await stage_file(exe.path, exec_file, runner.mode)
     if exe.filename == outfile_name:
         outfile = oufdir / f'{outfile_name}1'
 
     await copy_supplementary_files(args.supplementary_files, cwd)
 
-    # get runner and params
-    runner = runners[args.type]
+    # get params
     params: RunParams = runner.prepare(exec_file)
 
     # run
     try:
         inf = None if infile is None else open(infile, 'r')
-        with open(outfile, 'w') as ouf:
+        with open(outfile, 'w') as ouf, timed('execute'):
             res: RunResult = runner.interpret_result(await run_with_limits(
                 params.argv,
                 cwd,
@@ -109,6 +108,7 @@ async def run(oufdir: PosixPath, cwd: PosixPath, input: Input, args: RunArgs) \
                 disable_stderr=True,
                 disable_proc=params.disable_procfs,
                 tmpfsmount=params.tmpfsmount,
+                timing=args.timing,
             ))
     finally:
         try:
@@ -117,6 +117,9 @@ async def run(oufdir: PosixPath, cwd: PosixPath, input: Input, args: RunArgs) \
         finally:
             pass
 
+    for phase, secs in res.phase_secs.items():
+        observe(f'sandbox_{phase}', secs)
+
     # return result
     if res.error is not None:
         return res
@@ -131,4 +134,6 @@ async def run(oufdir: PosixPath, cwd: PosixPath, input: Input, args: RunArgs) \
         output_path=outfile,
         resource_usage=res.resource_usage,
         input_path=infile,
+        cpu=res.cpu,
+        phase_secs=res.phase_secs,
     )
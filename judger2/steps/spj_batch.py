@@ -0,0 +1,277 @@
+'''
+Batch SPJ checkers: a single checker process per task judges all its
+testpoints. The checker is started as
+
+    ./spj --batch
+
+and reads one line per testpoint from stdin, with the paths of the input,
+the user output, the answer and the working dir of the user program
+separated by tabs. For every line, it writes one line to stdout: the score,
+followed by a space and the message.
+
+As the checker outlives any single testpoint, the files of a testpoint
+cannot be bind mounted into its sandbox one by one. Instead, they are
+staged into the working dir of the checker before each line is sent, and
+the working dirs of the user program of a task that uses a batch checker
+are created under a per-task dir, which is mounted read-write into the
+checker as the working dir is for a per-testpoint checker.
+'''
+
+__all__ = 'spj_batch_scope', 'checker_spj_batch', 'batch_user_dir'
+
+from asyncio import (Future, Lock, Task, TimeoutError, create_task,
+                     get_running_loop, shield, wait_for)
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import replace
+from logging import getLogger
+from os import close, devnull, pipe, write
+from pathlib import PosixPath
+from shutil import rmtree
+from subprocess import Popen
+from typing import IO, AsyncIterator, Dict, List, Optional
+
+from commons.task_typing import (CheckResult, Input, JudgeTask, RunResult,
+                                 SpjChecker)
+from commons.util import TempDir, asyncrun, format_exc
+from judger2.cache import ensure_cached
+from judger2.config import relative_slowness
+from judger2.sandbox import run_with_limits, time_tolerance_ratio
+from judger2.steps.compile_ import NotCompiledException, ensure_input
+from judger2.util import copy_supplementary_files, elf_mode, stage_file
+
+logger = getLogger(__name__)
+
+
+def testpoint_timeout_secs(checker: SpjChecker) -> float:
+    # as for a per-testpoint checker, see run_with_limits.
+    return checker.limits.time_msecs * relative_slowness / 1000 \
+        * time_tolerance_ratio + 1.0
+
+
+class BatchChecker:
+    def __init__(self, checker: SpjChecker, testpoint_count: int,
+                 user_dir: PosixPath):
+        # the executable, supplementary files and limits of checker are
+        # shared by all testpoints using this batch checker; the answer is
+        # that of each testpoint.
+        self.checker = checker
+        self.testpoint_count = testpoint_count
+        self.user_dir = user_dir
+        self.lock = Lock()
+        self.started = False
+        self.error: Optional[str] = None
+        self._temp_dir: Optional[TempDir] = None
+        self._cwd: Optional[PosixPath] = None
+        self._count = 0
+        self._run: Optional['Task[RunResult]'] = None
+        self._proc: Optional[Popen] = None
+        # the pending request to the checker, run in a thread.
+        self._exchange: Optional['Future[bytes]'] = None
+        self._stdin: Optional[int] = None
+        self._stdout: Optional[IO[bytes]] = None
+        # pipe ends for the checker, closed here once it is spawned.
+        self._child_fds: List[int] = []
+
+    async def start(self):
+        self.started = True
+        try:
+            exe = (await ensure_input(self.checker.executable)).path
+        except NotCompiledException as e:
+            self.error = f'cannot compile spj: {e}'
+            return
+        self._temp_dir = TempDir()
+        cwd = self._cwd = self._temp_dir.__enter__()
+        exec_file = cwd / 'spj'
+        await stage_file(exe, exec_file, elf_mode)
+        await copy_supplementary_files(self.checker.supplementary_files, cwd)
+
+        in_r, in_w = pipe()
+        out_r, out_w = pipe()
+        self._stdin = in_w
+        self._stdout = open(out_r, 'rb')
+        self._child_fds = [in_r, out_w]
+        def after_spawn(proc: Popen):
+            self._proc = proc
+            # so that we see EOF if the checker exits.
+            while len(self._child_fds) > 0:
+                close(self._child_fds.pop())
+        # the limits of the checker are per testpoint.
+        limits = replace(self.checker.limits,
+            time_msecs=self.checker.limits.time_msecs * self.testpoint_count)
+        self._run = create_task(run_with_limits(
+            [str(exec_file), '--batch'],
+            cwd,
+            limits,
+            infile=in_r,
+            outfile=out_w,
+            supplementary_paths=['/bin', '/usr/bin'],
+            supplementary_paths_rw=[self.user_dir],
+            after_spawn=after_spawn,
+            # the checker mostly waits for testpoints, which need the cpus.
+            pin_cpu=False,
+        ))
+
+    async def stage(self, infile: Optional[PosixPath], outfile: PosixPath,
+                    answer: Optional[PosixPath]) -> PosixPath:
+        '''Stages the files of a testpoint into the checker dir.'''
+        assert self._cwd is not None
+        self._count += 1
+        dir = self._cwd / f'testpoint-{self._count}'
+        dir.mkdir()
+        dir.chmod(0o750)
+        for name, path in (('input', infile), ('output', outfile),
+                           ('answer', answer)):
+            if path is not None:
+                await stage_file(path, dir / name)
+        return dir
+
+    async def check(self, infile: Optional[PosixPath], outfile: PosixPath,
+                    user_cwd: PosixPath, checker: SpjChecker) -> CheckResult:
+        # import here to avoid circular reference
+        from judger2.steps.check import checker_parse_score
+        async with self.lock:
+            if not self.started:
+                try:
+                    await self.start()
+                except Exception as e:
+                    logger.error(f'cannot start batch checker: {format_exc(e)}')
+                    self.error = f'cannot start checker: {e}'
+            if self.error is not None:
+                return CheckResult('bad_problem', self.error)
+            assert self._stdin is not None and self._stdout is not None
+            answer = None if checker.answer is None else \
+                (await ensure_cached(checker.answer)).path
+            dir = await self.stage(infile, outfile, answer)
+            inf = devnull if infile is None else str(dir / 'input')
+            ans = devnull if answer is None else str(dir / 'answer')
+            request = '\t'.join([inf, str(dir / 'output'), ans, str(user_cwd)])
+            stdin, stdout = self._stdin, self._stdout
+            def exchange() -> bytes:
+                write(stdin, f'{request}\n'.encode())
+                return stdout.readline()
+            self._exchange = get_running_loop().run_in_executor(None, exchange)
+            try:
+                line = await wait_for(shield(self._exchange),
+                                      testpoint_timeout_secs(checker))
+            except TimeoutError:
+                self.error = 'checker error: time limit exceeded'
+                await self._finish(kill=True)
+                return CheckResult('bad_problem', self.error)
+            except OSError as e:
+                line = b''
+                logger.debug(f'cannot talk to batch checker: {e}')
+            finally:
+                await asyncrun(lambda: rmtree(dir, ignore_errors=True))
+            if line == b'':
+                self.error = f'checker error: {await self._finish(kill=True)}'
+                return CheckResult('bad_problem', self.error)
+            text = line.decode(errors='replace').rstrip('\n')
+            score, _, message = text.partition(' ')
+            return checker_parse_score(score, message)
+
+    async def _finish(self, kill: bool) -> str:
+        '''
+        Stops the checker, killing it if it is still running and kill is
+        set, and returns its error message.
+        '''
+        if self._stdin is not None:
+            close(self._stdin)
+            self._stdin = None
+        while len(self._child_fds) > 0:
+            close(self._child_fds.pop())
+        if self._run is None:
+            return ''
+        if kill and self._proc is not None and not self._run.done():
+            # not reaped yet, as run_with_limits has not returned.
+            self._proc.kill()
+        try:
+            res = await self._run
+        except Exception as e:
+            return format_exc(e)
+        finally:
+            self._run = None
+            if self._exchange is not None:
+                # all write ends of stdout are closed now, so the thread
+                # reading from it returns.
+                try:
+                    await self._exchange
+                except Exception:
+                    pass
+                self._exchange = None
+        return res.message if res.error is not None else 'checker exited'
+
+    async def close(self):
+        try:
+            # the task is done with the checker, or aborted.
+            await self._finish(kill=True)
+        finally:
+            if self._stdout is not None:
+                self._stdout.close()
+            if self._temp_dir is not None:
+                self._temp_dir.__exit__(None, None, None)
+
+
+_checkers: ContextVar[Optional[Dict[str, BatchChecker]]] = \
+    ContextVar('batch_checkers', default=None)
+_testpoint_count: ContextVar[int] = ContextVar('testpoint_count', default=1)
+_user_dir: ContextVar[Optional[PosixPath]] = \
+    ContextVar('batch_user_dir', default=None)
+
+def uses_batch_checker(task: JudgeTask[Input]) -> bool:
+    return any(isinstance(testpoint.check, SpjChecker)
+               and testpoint.check.format == 'batch'
+               for testpoint in task.testpoints)
+
+@asynccontextmanager
+async def spj_batch_scope(task: JudgeTask[Input]) -> AsyncIterator[None]:
+    '''Batch checkers started in this scope are stopped when it exits.'''
+    if not uses_batch_checker(task):
+        yield
+        return
+    checkers: Dict[str, BatchChecker] = {}
+    with TempDir() as user_dir:
+        token = _checkers.set(checkers)
+        count_token = _testpoint_count.set(len(task.testpoints))
+        dir_token = _user_dir.set(user_dir)
+        try:
+            yield
+        finally:
+            _checkers.reset(token)
+            _testpoint_count.reset(count_token)
+            _user_dir.reset(dir_token)
+            for checker in checkers.values():
+                try:
+                    await checker.close()
+                except Exception as e:
+                    logger.error(f'error stopping batch checker: '
+                                 f'{format_exc(e)}')
+
+def batch_user_dir() -> Optional[PosixPath]:
+    '''
+    Returns the dir the working dirs of the user program should be created
+    in, so that a batch checker can access them; None if the current task
+    does not use one.
+    '''
+    return _user_dir.get()
+
+async def checker_spj_batch(infile: Optional[PosixPath], outfile: PosixPath,
+                            user_cwd: PosixPath, checker: SpjChecker) \
+    -> Optional[CheckResult]:
+    '''
+    Checks with the batch checker of the current task. Returns None outside
+    of a spj_batch_scope, where the checker should be run per testpoint.
+    '''
+    checkers = _checkers.get()
+    user_dir = _user_dir.get()
+    if checkers is None or user_dir is None:
+        return None
+    if user_cwd.parent != user_dir:
+        # not in the dir mounted into the checker.
+        return None
+    key = repr((checker.executable, checker.supplementary_files,
+                checker.limits))
+    if key not in checkers:
+        checkers[key] = BatchChecker(checker, _testpoint_count.get(),
+                                     user_dir)
+    return await checkers[key].check(infile, outfile, user_cwd, checker)
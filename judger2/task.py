@@ -1,20 +1,27 @@
-from asyncio import CancelledError
+from asyncio import (CancelledError, Lock, Semaphore, Task,
+                     create_task, gather, sleep)
 from logging import getLogger
 from pathlib import PosixPath
-from typing import List, Optional, Sequence, Union
+from time import monotonic
+from typing import Dict, List, Optional, Sequence, Union
 
 from typing_extensions import overload
 
 from commons.task_typing import (Artifact, CompileResult, CompileTask, Input,
                                  InvalidTaskException, JudgeResult, JudgeTask,
-                                 RunResult, StatusUpdateProgress, Testpoint,
-                                 TestpointJudgeResult)
-from commons.util import format_exc, serialize
-from judger2.config import queues, redis, task_timeout_secs
+                                 RunResult, StatusUpdateProgressDelta,
+                                 Testpoint, TestpointJudgeResult)
+from commons.util import format_exc, push_with_expiry, serialize
+from judger2.cache import pin_scope
+from judger2.config import (progress_interval_secs, queues, redis,
+                            task_timeout_secs, testpoint_concurrency)
 from judger2.logging_ import task_logger
+from judger2.metrics import phase_scope, timed
+from judger2.prefetch import prefetch_task
 from judger2.steps.check import check
 from judger2.steps.compile_ import compile
 from judger2.steps.run import run
+from judger2.steps.spj_batch import batch_user_dir, spj_batch_scope
 from judger2.util import TempDir, copy_supplementary_files
 
 logger = getLogger(__name__)
@@ -27,21 +34,32 @@ async def run_task(task: JudgeTask[Input], task_id: str) -> JudgeResult: pass
 async def run_task(task, task_id):
     task_logger.info(f'received task {task_id}')
     task_logger.debug(f'received task {task_id}: {task}')
-    if isinstance(task, CompileTask):
-        return await compile_task(task)
-    elif isinstance(task, JudgeTask):
-        return await judge_task(task, task_id)
-    else:
-        raise InvalidTaskException(f'Unknown task type')
+    # files cached for the task must not be evicted while it runs.
+    with pin_scope(), timed('task'):
+        if isinstance(task, CompileTask):
+            return await compile_task(task)
+        elif isinstance(task, JudgeTask):
+            prefetcher = create_task(prefetch_task(task))
+            try:
+                async with spj_batch_scope(task):
+                    return await judge_task(task, task_id)
+            finally:
+                prefetcher.cancel()
+        else:
+            raise InvalidTaskException(f'Unknown task type')
 
 
 async def compile_task(task: CompileTask) -> CompileResult:
-    try:
-        return (await compile(task)).result
-    except CancelledError:
-        return CompileResult(result='aborted', message='')
-    except Exception as e:
-        return CompileResult(result='system_error', message=format_exc(e))
+    with phase_scope() as phases:
+        try:
+            with timed('compile'):
+                result = (await compile(task)).result
+        except CancelledError:
+            result = CompileResult(result='aborted', message='')
+        except Exception as e:
+            result = CompileResult(result='system_error', message=format_exc(e))
+    result.phases = phases
+    return result
 
 
 def get_skip_reason(
@@ -110,17 +128,104 @@ async def judge_testpoint(testpoint: Testpoint[Input], result: JudgeResult, \
         task_logger.debug(f'testpoint {testpoint.id} finished with {res}')
         return res
 
+class ProgressReporter:
+    '''
+    Sends the testpoints finished since the last progress update to the
+    scheduler. Testpoints finishing within progress_interval_secs of the
+    last update are coalesced into the next one.
+    '''
+
+    def __init__(self, task_id: str):
+        self.queue = queues.task(task_id).progress
+        self.pending: List[TestpointJudgeResult] = []
+        self.last_sent = 0.0
+        self.delayed: Optional['Task[None]'] = None
+        # updates are sent one at a time, in order.
+        self.lock = Lock()
+
+    async def add(self, result: TestpointJudgeResult):
+        self.pending.append(result)
+        if self.delayed is not None:
+            return
+        delay = self.last_sent + progress_interval_secs - monotonic()
+        if delay <= 0:
+            await self.flush()
+        else:
+            self.delayed = create_task(self.flush_after(delay))
+
+    async def flush_after(self, delay: float):
+        await sleep(delay)
+        self.delayed = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if len(self.pending) == 0:
+                return
+            testpoints, self.pending = self.pending, []
+            self.last_sent = monotonic()
+            update = StatusUpdateProgressDelta(testpoints)
+            await push_with_expiry(redis, self.queue, serialize(update),
+                                   task_timeout_secs)
+
+    def close(self):
+        # the final result is sent in full anyway.
+        if self.delayed is not None:
+            self.delayed.cancel()
+            self.delayed = None
+
+
+def shares_disk(task: JudgeTask[Input]) -> bool:
+    # The plan puts several testpoints in a task only for a DiskLimit
+    # group, whose testpoints share one working dir (and its disk quota):
+    # a testpoint may read files left by any earlier one, whether or not
+    # it declares a dependency on it.
+    return any(testpoint.run is not None
+               and testpoint.run.limits.file_size_bytes != 0
+               for testpoint in task.testpoints)
+
+def dependency_chains(task: JudgeTask[Input]) -> List[List[int]]:
+    '''
+    Groups the testpoints of task (by index) into chains, each judged in
+    order in a working dir of its own, while different chains may be
+    judged concurrently. If the testpoints share their disk space, they
+    all form a single chain; otherwise a testpoint joins the chain of the
+    testpoint it depends on, if that one is listed before it.
+    '''
+    if shares_disk(task):
+        return [list(range(len(task.testpoints)))]
+    chain_of: Dict[str, int] = {}
+    chains: List[List[int]] = []
+    for i, testpoint in enumerate(task.testpoints):
+        dep = testpoint.dependent_on
+        if dep is not None and dep in chain_of:
+            chain = chain_of[dep]
+        else:
+            chain = len(chains)
+            chains.append([])
+        chains[chain].append(i)
+        chain_of.setdefault(testpoint.id, chain)
+    return chains
+
 async def judge_task(task: JudgeTask[Input], task_id: str) -> JudgeResult:
     result = JudgeResult([None for _ in task.testpoints])  # type: ignore
-    with TempDir() as cwd:
-        for i, testpoint in enumerate(task.testpoints):
-            rusage = Ref(None)
+    progress = ProgressReporter(task_id)
+    try:
+        return await judge_testpoints(task, result, progress)
+    finally:
+        progress.close()
+
+async def judge_testpoints(task: JudgeTask[Input], result: JudgeResult,
+                           progress: ProgressReporter) -> JudgeResult:
+
+    async def judge(i: int, testpoint: Testpoint[Input], cwd: PosixPath):
+        rusage = Ref(None)
+        with phase_scope() as phases:
             try:
                 result.testpoints[i] = \
                     await judge_testpoint(testpoint, result, cwd, rusage)
-
             except CancelledError:
-                return result
+                raise
             except Exception as e:
                 logger.error(f'Error judging testpoint: {format_exc(e)}')
                 result.testpoints[i] = TestpointJudgeResult(
@@ -129,9 +234,32 @@ async def judge_task(task: JudgeTask[Input], task_id: str) -> JudgeResult:
                     message=str(e),
                     resource_usage=rusage.value,
                 )
+        result.testpoints[i].phases = phases
+
+        await progress.add(result.testpoints[i])
 
-            queue = queues.task(task_id).progress
-            await redis.lpush(queue, serialize(StatusUpdateProgress(result)))
-            await redis.expire(queue, task_timeout_secs)
+    if testpoint_concurrency <= 1:
+        with TempDir(batch_user_dir()) as cwd:
+            for i, testpoint in enumerate(task.testpoints):
+                try:
+                    await judge(i, testpoint, cwd)
+                except CancelledError:
+                    return result
+        return result
 
+    semaphore = Semaphore(testpoint_concurrency)
+    async def judge_chain(chain: List[int]):
+        async with semaphore:
+            with TempDir(batch_user_dir()) as cwd:
+                for i in chain:
+                    await judge(i, task.testpoints[i], cwd)
+    tasks = [create_task(judge_chain(chain))
+             for chain in dependency_chains(task)]
+    try:
+        await gather(*tasks)
+    except CancelledError:
+        pass
+    finally:
+        for t in tasks:
+            t.cancel()
     return result
@@ -1,14 +1,24 @@
 from asyncio import as_completed
+from contextlib import contextmanager
+from fcntl import ioctl
+from functools import lru_cache
 from logging import getLogger
+from os import chmod, getuid, link, stat
 from pathlib import PosixPath
-from shutil import copy2
-from typing import Dict, List, Tuple, Union
+from shutil import copy2, copymode
+from stat import S_IMODE
+from subprocess import DEVNULL, PIPE, STDOUT
+from subprocess import run as run_process
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 from commons.task_typing import FileUrl
-from commons.util import TempDir, format_exc
+from commons.util import TempDir, asyncrun, format_exc
 
 from judger2.cache import ensure_cached
+from judger2.cleanup import schedule_removal
 from judger2.config import working_dir
+from judger2.metrics import timed
 
 logger = getLogger(__name__)
 
@@ -30,7 +40,50 @@ def _judger_before_tmpdir_exit(path: PosixPath):
     except Exception as e:
         logger.error(f'error removing temp dir {path}: {format_exc(e)}')
 
-TempDir.config(working_dir, _judger_before_tmpdir_exit)
+TempDir.config(working_dir, _judger_before_tmpdir_exit, schedule_removal)
+
+
+# ioctl(2) request to share the extents of a file (a reflink) on
+# filesystems supporting it, see ioctl_ficlone(2).
+FICLONE = 0x40049409
+
+def reflink(src: PosixPath, dest: PosixPath):
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+    copymode(src, dest)
+
+# mode of staged executables.
+elf_mode = 0o550
+
+async def stage_file(src: PosixPath, dest: PosixPath,
+                     mode: Optional[int] = None):
+    '''
+    Makes the file src available at dest, avoiding a byte copy if possible.
+    If mode is given, dest gets that mode.
+
+    A hardlink is used when src could not be modified through it, i.e.
+    src belongs to us and is not writable by group or others, and already
+    has the requested mode (a hardlink shares the mode of src, which must
+    not be changed for its other users); otherwise a reflink is tried.
+    Only when neither works (e.g. across filesystems) is the file copied,
+    off the event loop.
+    '''
+    with timed('stage'):
+        st = stat(src)
+        if st.st_uid == getuid() and st.st_mode & 0o022 == 0 \
+        and (mode is None or S_IMODE(st.st_mode) == mode):
+            try:
+                link(src, dest)
+                return
+            except OSError as e:
+                logger.debug(f'cannot hardlink {src} to {dest}: {e}')
+        try:
+            reflink(src, dest)
+        except OSError as e:
+            logger.debug(f'cannot reflink {src} to {dest}: {e}')
+            await asyncrun(lambda: copy2(src, dest))
+        if mode is not None:
+            chmod(dest, mode)
 
 
 class InvalidProblemException(Exception): pass
@@ -45,7 +98,7 @@ async def copy_supplementary_files(files: List[FileUrl], cwd: PosixPath):
             dest = cwd / file.filename
             if dest.is_file():
                 raise FileConflictException(f'File \'{file.filename}\' already exists')
-            copy2(file.path, dest)
+            await stage_file(file.path, dest)
         except FileConflictException:
             raise
         except Exception as e:
@@ -65,3 +118,26 @@ def format_args(args: Dict[str, Union[bool, str, List[str]]]) -> List[str]:
             return sum(map(lambda x: [k, x], v), [])
         return [k, v]
     return sum(map(format_arg, args.items()), [])
+
+
+class PhaseTimer:
+    '''Accumulates the wall time spent in named phases of some work.'''
+
+    def __init__(self):
+        self.secs: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.secs[name] = self.secs.get(name, 0.0) + perf_counter() - start
+
+
+@lru_cache(maxsize=None)
+def toolchain_version(exe: str, flag: str) -> str:
+    '''Returns the version string printed by `exe flag`.'''
+    res = run_process([exe, flag], stdin=DEVNULL, stdout=PIPE, stderr=STDOUT,
+                      timeout=10.0)
+    return res.stdout.decode(errors='replace')
@@ -0,0 +1,67 @@
+'''
+Compares the latency of dispatching a task and pushing its progress with
+one round trip per command against pipelined round trips. Run with
+    python3 -m scheduler2.bench_dispatch [tasks] [redis url]
+from the repository root, against a local Redis that can be written to;
+the url defaults to redis://localhost:6379/15.
+'''
+
+from asyncio import run
+from statistics import median
+from sys import argv
+from time import perf_counter
+from uuid import uuid4
+
+from redis.asyncio import Redis
+
+from commons.util import RedisQueues, push_with_expiry
+
+ttl_secs = 60
+# about the size of a serialized judge task with a few testpoints.
+payload = 'x' * 4096
+
+
+async def dispatch_sequential(redis: Redis, queues: RedisQueues):
+    task_queues = queues.task(str(uuid4()))
+    await redis.lpush(task_queues.task, payload)
+    await redis.expire(task_queues.task, ttl_secs)
+    await redis.lpush(queues.tasks_group('bench'), 'id')
+    await redis.lpush(task_queues.progress, payload)
+    await redis.expire(task_queues.progress, ttl_secs)
+
+async def dispatch_pipelined(redis: Redis, queues: RedisQueues):
+    task_queues = queues.task(str(uuid4()))
+    async with redis.pipeline(transaction=True) as pipe:
+        await pipe.lpush(task_queues.task, payload) \
+            .expire(task_queues.task, ttl_secs) \
+            .lpush(queues.tasks_group('bench'), 'id') \
+            .execute()
+    await push_with_expiry(redis, task_queues.progress, payload, ttl_secs)
+
+
+async def main():
+    tasks = int(argv[1]) if len(argv) > 1 else 1000
+    url = argv[2] if len(argv) > 2 else 'redis://localhost:6379/15'
+    redis = Redis.from_url(url)
+    queues = RedisQueues(f'bench-{uuid4()}')
+    try:
+        for name, dispatch in (('sequential', dispatch_sequential),
+                               ('pipelined', dispatch_pipelined)):
+            secs = []
+            for _ in range(tasks):
+                start = perf_counter()
+                await dispatch(redis, queues)
+                secs.append(perf_counter() - start)
+            secs.sort()
+            print(f'{name}: {tasks} tasks, median '
+                  f'{median(secs) * 1e6:.0f} us, p99 '
+                  f'{secs[int(len(secs) * 0.99)] * 1e6:.0f} us per task')
+    finally:
+        keys = [x async for x in redis.scan_iter(f'{queues._prefix}-*')]
+        if len(keys) > 0:
+            await redis.delete(*keys)
+        await redis.close()
+
+
+if __name__ == '__main__':
+    run(main())
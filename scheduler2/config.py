@@ -24,6 +24,11 @@ class S3Buckets:
     artifacts: str
 s3_buckets = S3Buckets(**config['s3']['buckets'])
 
+# whether runners are asked to prefetch the files of a problem into their
+# caches when it is updated, so that the first submissions do not all
+# fetch them from S3 at once.
+prefetch_on_update = bool(config.get('prefetch_on_update', False))
+
 
 def plan_key(problem_id: str) -> str:
     return f'plans/{problem_id}.json'
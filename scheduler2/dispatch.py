@@ -10,8 +10,9 @@ import commons.task_typing
 from commons.task_typing import (CompileResult, CompileTask, Input,
                                  JudgeResult, JudgeTask, StatusUpdate,
                                  StatusUpdateDone, StatusUpdateError,
-                                 StatusUpdateProgress, StatusUpdateStarted)
-from commons.util import deserialize, serialize
+                                 StatusUpdateProgress,
+                                 StatusUpdateProgressDelta, StatusUpdateStarted)
+from commons.util import deserialize, push_with_expiry, serialize
 from scheduler2.config import (redis, redis_queues,
                                task_concurrency_per_account, task_retries,
                                task_retry_interval_secs, task_timeout_secs)
@@ -60,9 +61,13 @@ async def run_task(taskinfo, onprogress = None, rate_limit_group = None,
             logger.debug(f'running task {task_id}: {task}')
 
             queues = redis_queues.task(task_id)
-            await redis.lpush(queues.task, serialize(task))
-            await redis.expire(queues.task, task_timeout_secs)
-            await redis.lpush(redis_queues.tasks_group(taskinfo.group), task_id)
+            # the task must be stored before its id is queued, so that a
+            # runner never picks up the id of a task it cannot find.
+            async with redis.pipeline(transaction=True) as pipe:
+                await pipe.lpush(queues.task, serialize(task)) \
+                    .expire(queues.task, task_timeout_secs) \
+                    .lpush(redis_queues.tasks_group(taskinfo.group), task_id) \
+                    .execute()
             task_timeout = time() + task_timeout_secs
 
             offline_task = None
@@ -89,7 +94,8 @@ async def run_task(taskinfo, onprogress = None, rate_limit_group = None,
                         offline_task = wait_until_offline(status.id)
                         if onprogress is not None:
                             await onprogress(status)
-                    elif isinstance(status, StatusUpdateProgress):
+                    elif isinstance(status, (StatusUpdateProgress,
+                                             StatusUpdateProgressDelta)):
                         if onprogress is not None:
                             await onprogress(status)
                     elif isinstance(status, StatusUpdateDone):
@@ -103,8 +109,8 @@ async def run_task(taskinfo, onprogress = None, rate_limit_group = None,
                         raise Exception(f'Unknown message from runner: {status}')
             except CancelledError:
                 logger.info(f'aborting task {task_id}')
-                await redis.lpush(queues.abort, 1)
-                await redis.expire(queues.abort, task_timeout_secs)
+                await push_with_expiry(redis, queues.abort, 1,
+                                       task_timeout_secs)
                 raise
     finally:
         del taskinfo_from_task_id[task_id]
@@ -1,6 +1,6 @@
 __import__('scheduler2.logging_')
 
-from asyncio import CancelledError, Future, Task, create_task, shield, wait
+from asyncio import CancelledError, Future, Task, create_task, shield
 from atexit import register
 from dataclasses import asdict
 from http.client import BAD_REQUEST
@@ -16,11 +16,12 @@ from botocore.exceptions import ClientError
 from commons.task_typing import (CodeLanguage, ProblemJudgeResult,
                                  SourceLocation)
 from commons.util import deserialize, dump_dataclass, format_exc, serialize
-from scheduler2.config import (host, plan_key, port,
+from scheduler2.config import (host, plan_key, port, prefetch_on_update,
                                runner_heartbeat_interval_secs, s3_buckets)
-from scheduler2.monitor import get_runner_status
+from scheduler2.monitor import get_runner_statuses
 from scheduler2.plan import (InvalidCodeException, InvalidProblemException,
-                             execute_plan, generate_plan, get_partial_result)
+                             broadcast_prefetch, execute_plan, generate_plan,
+                             get_partial_result)
 from scheduler2.plan.languages import languages_accepted
 from scheduler2.s3 import read_file, upload_str
 from scheduler2.util import make_request
@@ -72,6 +73,13 @@ async def update_problem(request: Request):
         languages = languages_accepted(plan)
         plan_str = serialize(plan)
         await upload_str(s3_buckets.problems, plan_key(problem_id), plan_str)
+        if prefetch_on_update:
+            try:
+                await broadcast_prefetch(problem_id, plan)
+            except Exception as e:
+                # only a warm-up; the problem is updated anyway.
+                logger.warning(f'cannot broadcast prefetch of {problem_id}: '
+                               f'{format_exc(e)}')
     except InvalidProblemException as e:
         return json_response({'result': 'invalid problem', 'error': str(e)})
     except Exception as e:
@@ -187,12 +195,10 @@ async def runner_status(request: Request):
     if cached_runner_status is None:
         if runner_status_future is None:
             runner_status_future = Future()
-            async def stat(id):
-                return (id, asdict(await get_runner_status(id)))
             try:
-                tasks = [create_task(stat(x)) for x in ids]
-                tasks, _ = await wait(tasks)
-                cached_runner_status = dict([await x for x in tasks])
+                statuses = await get_runner_statuses(ids)
+                cached_runner_status = \
+                    dict((k, asdict(v)) for k, v in statuses.items())
                 cached_runner_status_time = time()
                 runner_status_future.set_result(cached_runner_status)
             except Exception as e:
@@ -1,12 +1,13 @@
-from asyncio import Task, create_task, sleep
-from dataclasses import dataclass
+from asyncio import Task, create_task, gather, sleep
+from dataclasses import dataclass, field
 from logging import getLogger
 from time import time
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 from typing_extensions import Literal
 
-from commons.util import RedisQueues, format_exc
+from commons.task_typing import RunnerHeartbeat
+from commons.util import RedisQueues, deserialize, format_exc
 from scheduler2.config import (redis, redis_queues,
                                runner_heartbeat_interval_secs)
 from scheduler2.util import RunnerOfflineException, taskinfo_from_task_id
@@ -19,35 +20,52 @@ class RunnerStatus:
     status: Literal['invalid', 'idle', 'busy', 'offline']
     message: str
     last_seen: Optional[float]
+    # problems of the tasks the runner is running, if known.
+    problem_ids: List[str] = field(default_factory=list)
+    heartbeat: Optional[RunnerHeartbeat] = None
+
+def runner_status_of(task_ids: List[str], slots: int, last_seen: float) \
+    -> RunnerStatus:
+    if last_seen < time() - runner_heartbeat_interval_secs * 2:
+        return RunnerStatus('offline', 'Offline', last_seen)
+    status: Literal['idle', 'busy', 'invalid']
+    def task_message(task_id: str) -> str:
+        if not task_id in taskinfo_from_task_id:
+            return 'Busy'
+        return taskinfo_from_task_id[task_id].message
+    if len(task_ids) == 0:
+        status = 'idle'
+        msg = 'Idle'
+    elif len(task_ids) > slots:
+        status = 'invalid'
+        msg = f'{len(task_ids)} tasks are running on a runner with {slots} slot(s)'
+    elif slots == 1:
+        status = 'busy'
+        msg = task_message(task_ids[0])
+    else:
+        status = 'busy'
+        messages = '; '.join(task_message(x) for x in task_ids)
+        msg = f'Busy ({len(task_ids)}/{slots}): {messages}'
+    problem_ids = [taskinfo_from_task_id[x].problem_id for x in task_ids
+                   if x in taskinfo_from_task_id]
+    return RunnerStatus(status, msg, last_seen, problem_ids)
 
 async def get_runner_status(runner_id: str):
+    '''Reads the status of a runner from the keys of the runner itself.'''
     heartbeat = None
     try:
         runner_info = RedisQueues.RunnerInfo(runner_id, '')
         runner_queues = redis_queues.runner(runner_info)
         heartbeat_str = await redis.get(runner_queues.heartbeat)
         heartbeat = float(heartbeat_str) if heartbeat_str is not None else None
-        if heartbeat is None \
-        or heartbeat < time() - runner_heartbeat_interval_secs * 2:
+        if heartbeat is None:
             return RunnerStatus('offline', 'Offline', heartbeat)
 
         task_ids = await redis.lrange(runner_queues.in_progress, 0, -1)
-        status: Literal['idle', 'busy', 'invalid']
-        if len(task_ids) == 0:
-            status = 'idle'
-            msg = 'Idle'
-        elif len(task_ids) == 1:
-            status = 'busy'
-            task_id = task_ids[0]
-            if not task_id in taskinfo_from_task_id:
-                msg = 'Busy'
-            else:
-                taskinfo = taskinfo_from_task_id[task_id]
-                msg = taskinfo.message
-        else:
-            status = 'invalid'
-            msg = 'Multiple tasks are running on this runner'
-        return RunnerStatus(status, msg, heartbeat)
+        slots_str = await redis.get(runner_queues.slots)
+        # runners predating multi-slot support do not report their slots.
+        slots = int(slots_str) if slots_str is not None else 1
+        return runner_status_of(task_ids, slots, heartbeat)
     except Exception as e:
         if not isinstance(heartbeat, float):
             heartbeat = None
@@ -55,6 +73,48 @@ async def get_runner_status(runner_id: str):
         logger.warn(msg)
         return RunnerStatus('invalid', msg, heartbeat)
 
+async def get_runner_heartbeats() -> Dict[str, RunnerHeartbeat]:
+    '''
+    Reads the latest heartbeats of all runners from the runners hashes of
+    all groups, in two round trips.
+    '''
+    groups = await redis.smembers(redis_queues.runner_groups)
+    async with redis.pipeline(transaction=False) as pipe:
+        for group in groups:
+            pipe.hgetall(redis_queues.runners_group(group))
+        hashes = await pipe.execute()
+    heartbeats: Dict[str, RunnerHeartbeat] = {}
+    for runners in hashes:
+        for runner_id, data in runners.items():
+            heartbeat: RunnerHeartbeat = deserialize(data)
+            # a runner moved to another group leaves an old entry behind.
+            if runner_id not in heartbeats \
+            or heartbeats[runner_id].time < heartbeat.time:
+                heartbeats[runner_id] = heartbeat
+    return heartbeats
+
+async def get_runner_statuses(runner_ids: List[str]) \
+    -> Dict[str, RunnerStatus]:
+    try:
+        heartbeats = await get_runner_heartbeats()
+    except Exception as e:
+        logger.warn(f'Cannot read runner heartbeats: {format_exc(e)}')
+        heartbeats = {}
+    statuses: Dict[str, RunnerStatus] = {}
+    for runner_id in runner_ids:
+        if runner_id in heartbeats:
+            heartbeat = heartbeats[runner_id]
+            status = runner_status_of(heartbeat.task_ids, heartbeat.slots,
+                                      heartbeat.time)
+            status.heartbeat = heartbeat
+            statuses[runner_id] = status
+    # runners predating the runners hash.
+    missing = [x for x in runner_ids if x not in statuses]
+    for runner_id, status in zip(missing,
+                                 await gather(*map(get_runner_status, missing))):
+        statuses[runner_id] = status
+    return statuses
+
 
 watch_tasks: Dict[str, Task] = {}
 
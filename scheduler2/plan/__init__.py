@@ -1,8 +1,9 @@
 __all__ = ('generate_plan', 'execute_plan', 'get_partial_result',
-           'languages_accepted', 'InvalidCodeException',
-           'InvalidProblemException')
+           'languages_accepted', 'broadcast_prefetch',
+           'InvalidCodeException', 'InvalidProblemException')
 
 from scheduler2.plan.execute import execute_plan, get_partial_result
 from scheduler2.plan.generate import generate_plan
 from scheduler2.plan.languages import languages_accepted
+from scheduler2.plan.prefetch import broadcast_prefetch
 from scheduler2.plan.util import InvalidCodeException, InvalidProblemException
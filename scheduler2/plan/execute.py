@@ -19,7 +19,8 @@ from commons.task_typing import (Artifact, CodeLanguage, CompareChecker,
                                  ProblemJudgeResult, QuizProblem,
                                  ResourceUsage, ResultType, SourceLocation,
                                  SpjChecker, StatusUpdate,
-                                 StatusUpdateProgress, StatusUpdateStarted,
+                                 StatusUpdateProgress,
+                                 StatusUpdateProgressDelta, StatusUpdateStarted,
                                  Testpoint, TestpointGroup,
                                  TestpointJudgeResult, UserCode)
 from commons.util import format_exc
@@ -164,7 +165,8 @@ async def prepare_compile(ctx, plan):
     artifact = Artifact(ctx.file_url(UrlType.ARTIFACT, artifact_filename)) \
         if plan.artifact else None
     limits = deepcopy(plan.limits)
-    return CompileTask(source, supplementary_files, artifact, limits)
+    return CompileTask(source, supplementary_files, artifact, limits,
+                       precompile_header=plan.precompile_header)
 
 
 async def get_judge_task(ctx: ExecutionContext, plan: JudgeTaskPlan) \
@@ -290,20 +292,25 @@ async def run_judge_tasks(ctx: ExecutionContext):
     def run(task: JudgeTaskRecord) -> Optional[ResType]:
         if len(task.task.testpoints) == 0:
             return None
+        def add_progress(testpoints: Iterable[Optional[TestpointJudgeResult]]):
+            for testpoint1 in testpoints:
+                if testpoint1 is not None and (
+                    not testpoint1.id in ctx.results
+                    or ctx.results[testpoint1.id].result
+                        in ('pending', 'judging')):
+                    ctx.results[testpoint1.id] = testpoint1
         async def onprogress(status: StatusUpdate):
             if isinstance(status, StatusUpdateStarted):
                 for testpoint in task.task.testpoints:
                     if not testpoint.id in ctx.results:
                         ctx.results[testpoint.id] = TestpointJudgeResult(
                             testpoint.id, 'judging', 'Judging')
+            elif isinstance(status, StatusUpdateProgressDelta):
+                add_progress(status.testpoints)
             elif isinstance(status, StatusUpdateProgress):
+                # sent by runners not yet sending deltas.
                 assert isinstance(status.result, JudgeResult)
-                for testpoint1 in status.result.testpoints:
-                    if testpoint1 is not None and (
-                        not testpoint1.id in ctx.results
-                        or ctx.results[testpoint1.id].result
-                            in ('pending', 'judging')):
-                        ctx.results[testpoint1.id] = testpoint1
+                add_progress(status.result.testpoints)
         async def run_with_rec():
             try:
                 msg = f'Running test for submission #{ctx.id}'
@@ -17,7 +17,7 @@ from commons.task_typing import (Artifact, Checker, CompareChecker,
                                  QuizOption, QuizProblem, ResourceUsage,
                                  RunArgs, SpjChecker, Testpoint,
                                  TestpointGroup, UserCode)
-from commons.util import format_exc
+from commons.util import NormalizedDigest, format_exc
 from scheduler2.config import (default_check_limits, default_compile_limits,
                                default_run_limits, problem_config_filename,
                                quiz_filename, s3_buckets, working_dir)
@@ -218,27 +218,38 @@ def parse_testpoint(ctx: ParseContext, conf: ConfigTestpoint) -> Testpoint:
         limits=run_limits,
         infile=infile,
         supplementary_files=[],
+        timing=ctx.cfg.TimeMetric,
     )
 
-    def ans() -> Optional[FileUrl]:
+    def ans_filename() -> Optional[str]:
         ans_filename = answer_name_template.format(id)
         if ans_filename in ctx.namelist():
-            return ctx.file_url(ans_filename)
+            return ans_filename
         ans_filename_alt = answer_name_template_alt.format(id)
         if ans_filename_alt in ctx.namelist():
-            return ctx.file_url(ans_filename_alt)
+            return ans_filename_alt
         return None
+    def ans() -> Optional[FileUrl]:
+        filename = ans_filename()
+        return None if filename is None else ctx.file_url(filename)
     if ctx.check_type == 'compare':
-        answer = ans()
-        if answer is None:
+        answer_filename = ans_filename()
+        if answer_filename is None:
             raise InvalidProblemException(f'Answer file needed for testpoint {id}')
-        check: Checker = CompareChecker(True, answer)
+        with ctx.open(answer_filename, 'r') as f:
+            digest = NormalizedDigest.of_file(f)
+        check: Checker = CompareChecker(
+            True,
+            ctx.file_url(answer_filename),
+            answer_digest=digest.hexdigest(),
+            answer_size=digest.size,
+        )
     elif ctx.check_type == 'direct':
         check = DirectChecker()
     elif ctx.check_type == 'spj':
         assert ctx.checker_artifact is not None
         check = SpjChecker(
-            format='checker',
+            format='batch' if ctx.cfg.SPJBatch else 'checker',
             executable=ctx.checker_artifact,
             answer=ans(),
             supplementary_files=[],
@@ -262,6 +273,9 @@ def parse_testpoint(ctx: ParseContext, conf: ConfigTestpoint) -> Testpoint:
         ctor: Union[Type[CompileSourceVerilog], Type[CompileSourceCpp]] = \
             CompileSourceVerilog if ctx.cfg.Verilog else CompileSourceCpp
         task.source = ctor(ctx.file_url(main_template.format(id)))
+        if not ctx.cfg.Verilog:
+            # the user code is the same for every testpoint.
+            task.precompile_header = hpp_src_filename
         testpoint.input = task
     return testpoint
 
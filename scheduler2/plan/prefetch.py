@@ -0,0 +1,72 @@
+from logging import getLogger
+from typing import Iterator, List, Union
+
+from commons.task_typing import (Artifact, CompareChecker, CompileSourceCpp,
+                                 CompileSourceVerilog, CompileTaskPlan,
+                                 InputPlan, JudgePlan, PrefetchRequest,
+                                 SpjChecker, UserCode)
+from commons.util import serialize
+from scheduler2.config import redis, redis_queues
+from scheduler2.plan.util import sign_url, url_scheme
+
+logger = getLogger(__name__)
+
+
+def compile_plan_urls(plan: CompileTaskPlan) -> Iterator[str]:
+    if isinstance(plan.source, (CompileSourceCpp, CompileSourceVerilog)):
+        yield plan.source.main
+    for file in plan.supplementary_files:
+        if not isinstance(file, UserCode):
+            yield file
+
+def input_plan_urls(input: Union[InputPlan, None]) -> Iterator[str]:
+    if isinstance(input, Artifact):
+        yield input.url
+    elif isinstance(input, CompileTaskPlan):
+        yield from compile_plan_urls(input)
+
+def plan_urls(plan: JudgePlan) -> List[str]:
+    '''
+    Returns the signed urls of the files of the problem that runners would
+    fetch while judging, in the order they are used.
+    '''
+    urls: List[str] = []
+    if plan.compile is not None:
+        urls.extend(compile_plan_urls(plan.compile))
+    for task in plan.judge:
+        for testpoint in task.task.testpoints:
+            urls.extend(input_plan_urls(testpoint.input))
+            if testpoint.run is not None:
+                if testpoint.run.infile is not None:
+                    urls.append(testpoint.run.infile)
+                urls.extend(testpoint.run.supplementary_files)
+            check = testpoint.check
+            if isinstance(check, CompareChecker):
+                # with a digest, the answer is only needed for wrong outputs.
+                if check.answer_digest is None:
+                    urls.append(check.answer)
+            elif isinstance(check, SpjChecker):
+                urls.extend(input_plan_urls(check.executable))
+                if check.answer is not None:
+                    urls.append(check.answer)
+                urls.extend(check.supplementary_files)
+    return [sign_url(x) for x in dict.fromkeys(urls)
+            if x.startswith(url_scheme)]
+
+
+async def broadcast_prefetch(problem_id: str, plan: JudgePlan):
+    '''
+    Asks the runners of the group of plan to fetch the files of the
+    problem into their caches in the background. Runners not listening
+    (e.g. offline ones) simply miss the request.
+    '''
+    if plan.quiz is not None:
+        return
+    urls = plan_urls(plan)
+    if len(urls) == 0:
+        return
+    channel = redis_queues.prefetch_group(plan.group)
+    message = serialize(PrefetchRequest(problem_id, urls))
+    receivers = await redis.publish(channel, message)
+    logger.info(f'asked {receivers} runners of group {plan.group} '
+                f'to prefetch {len(urls)} files of {problem_id}')
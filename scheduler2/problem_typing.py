@@ -4,7 +4,7 @@ from typing import List, Optional, Union
 
 from typing_extensions import Literal
 
-from commons.task_typing import DEFAULT_GROUP
+from commons.task_typing import DEFAULT_GROUP, TimeMetric
 
 
 @unique
@@ -41,8 +41,10 @@ class ProblemConfig:
     Groups: List[Group]
     CompileTimeLimit: Optional[int] = None
     SPJ: Spj = Spj.CLASSIC_COMPARE
+    SPJBatch: bool = False
     Scorer: Literal[0] = 0
     SupportedFiles: List[str] = field(default_factory=lambda: [])
     Verilog: bool = False
     Quiz: bool = False
     RunnerGroup: str = DEFAULT_GROUP
+    TimeMetric: TimeMetric = 'realtime'